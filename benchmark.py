@@ -0,0 +1,436 @@
+#!/usr/bin/python -tt
+
+'''
+################################################################################
+
+benchmark.py
+
+Times each stage of radmind_intermapper_diff.py against synthetic data, so that
+its performance can be measured without a Radmind server, an InterMapper server
+or a DNS server.  Everything runs offline: the Radmind config and InterMapper
+page are generated into a temporary directory, and socket.gethostbyaddr() and
+socket.gethostbyname_ex() are replaced with a fake resolver that gives the same
+answers every time and takes a set amount of time to give them.
+
+Each run appends its results (one JSON object per size) to the output file,
+and the table printed at the end compares every stage against the last run of
+the same size, so a slowdown between versions stands out.
+
+################################################################################
+
+DETAILED USAGE INSTRUCTIONS
+
+Optional arguments:
+
+  -h : display help information and quit
+
+  --sizes '#,#,...'  : generate about # addresses for each size given
+                       (default 1000,10000,100000; up to 1000000 is reasonable)
+  --repeat #         : run each stage # times and keep the fastest
+  --dns-sample #     : look up at most # hostnames per size
+  --latency #        : the fake resolver takes # milliseconds per lookup
+  --seed #           : seed for the random data (the same seed gives the same
+                       files every time)
+  --output 'file'    : append the results to 'file'
+  --keep 'dir'       : leave the generated files in 'dir' instead of deleting
+                       them
+
+Usage examples:
+
+%(PROG)s --sizes 1000,1000000 --repeat 1
+
+    Times every stage once against about a thousand and about a million
+    addresses, and adds the results to bench_output.txt.
+
+################################################################################
+
+COPYRIGHT (c) 2014 Marriott Library IT Services.  All Rights Reserved.
+
+Permission to use, copy, modify, and distribute this software and its
+documentation for any purpose and without fee is hereby granted, provided that
+the above copyright notice appears in all copies and that both that copyright
+notice and this permission notice appear in supporting documentation, and that
+the name of The Marriott Library not be used in advertising or publicity
+pertaining to distribution of the software without specific, written prior
+permission. This software is supplied as-is without expressed or implied
+warranties of any kind.
+
+################################################################################
+'''
+
+'''
+################################################################################
+IMPORTS
+################################################################################
+'''
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import radmind_intermapper_diff as rid
+
+'''
+################################################################################
+DEFINE GLOBAL VARIABLES
+################################################################################
+'''
+def set_gvars ():
+    global SIZES            # Default number of addresses to generate
+    global REPEAT           # Default times to run each stage
+    global DNS_SAMPLE       # Default most hostnames to look up per size
+    global LATENCY          # Default milliseconds per fake lookup
+    global SEED             # Default seed for the random data
+    global OUTPUT_FILE      # Default file the results are added to
+    global SLOWER           # Ratio to the last run that counts as a slowdown
+
+    SIZES       = "1000,10000,100000"
+    REPEAT      = 3
+    DNS_SAMPLE  = 2000
+    LATENCY     = 1.0
+    SEED        = 1
+    OUTPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "bench_output.txt")
+    SLOWER      = 1.2
+
+'''
+################################################################################
+MAIN
+################################################################################
+'''
+def main ():
+    set_gvars()
+    parse_options()
+
+    previous = load_previous()
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix="rid_bench_")
+        try:
+            results = run_size(size, directory)
+        finally:
+            if keep:
+                shutil.move(directory, os.path.join(keep, "size_" + str(size)))
+            else:
+                shutil.rmtree(directory)
+        save_results(results)
+        print_results(results, previous.get(size))
+
+'''
+################################################################################
+PARSE ARGUMENTS
+################################################################################
+'''
+def parse_options ():
+    parser = argparse.ArgumentParser(
+        description="Times each stage of radmind_intermapper_diff.py against "
+                    "synthetic data.")
+    parser.add_argument("--sizes",
+                        dest='sizes',
+                        default=SIZES)
+    parser.add_argument("--repeat",
+                        dest='repeat',
+                        type=int,
+                        default=REPEAT)
+    parser.add_argument("--dns-sample",
+                        dest='dns_sample',
+                        type=int,
+                        default=DNS_SAMPLE)
+    parser.add_argument("--latency",
+                        dest='latency',
+                        type=float,
+                        default=LATENCY)
+    parser.add_argument("--seed",
+                        dest='seed',
+                        type=int,
+                        default=SEED)
+    parser.add_argument("--output",
+                        dest='output_file',
+                        default=OUTPUT_FILE)
+    parser.add_argument("--keep",
+                        dest='keep',
+                        default=None)
+
+    globals().update(vars(parser.parse_args()))
+
+    global sizes
+    sizes = [int(size) for size in sizes.split(',') if size.strip()]
+    if keep and not os.path.isdir(keep):
+        os.makedirs(keep)
+
+'''
+################################################################################
+SYNTHETIC DATA
+
+    Addresses are handed out a /24 at a time in 10.0.0.0/8.  Each block is
+    either written to the Radmind config as a.b.c.<d-e> ranges (often two of
+    them overlapping, which the real configs have plenty of) or as a handful of
+    single addresses, some of them listed twice.  Most of every block goes into
+    the InterMapper page too, along with a few addresses in 172.16.0.0/12 that
+    Radmind has never heard of, so both sides have a disparity.
+
+    The range blocks go into a second file (rm_path + ".labs") that the config
+    pulls in with an indented @include line, so reading the config (with both
+    parsers) follows an include the same way it would for a real one.
+################################################################################
+'''
+def make_sources (size, rm_path, im_path):
+    rng = random.Random(seed + size)
+    listed = 0
+    block = 0
+    labs_path = rm_path + ".labs"
+    with open(rm_path, 'w') as rm, open(labs_path, 'w') as labs:
+        with open(im_path, 'w') as im:
+            rm.write("# synthetic radmind config (" + str(size)
+                     + " addresses)\n")
+            rm.write("  @include " + os.path.basename(labs_path) + "\n")
+            im.write("<html><body><table>\n")
+            while listed < size:
+                base = (10 << 24) + (block << 8)
+                prefix = rid.int_to_ip(base)[:-1]
+                block += 1
+
+                if rng.random() < 0.4:
+                    first = rng.randint(1, 100)
+                    last = min(254, first + rng.randint(10, 150))
+                    ranges = [(first, last)]
+                    if rng.random() < 0.5:
+                        second = rng.randint(first, last)
+                        ranges.append((second, min(254, second
+                                                   + rng.randint(5, 60))))
+                    for first, last in ranges:
+                        labs.write(prefix + "<" + str(first) + "-" + str(last)
+                                   + ">\tlab_" + str(block) + ".K\n")
+                        listed += last - first + 1
+                    members = set()
+                    for first, last in ranges:
+                        members.update(range(first, last + 1))
+                else:
+                    members = set(rng.sample(xrange(1, 255),
+                                             rng.randint(5, 60)))
+                    for last in sorted(members):
+                        count = 1
+                        if rng.random() < 0.05:
+                            count = 2
+                        for i in range(0, count):
+                            rm.write(prefix + str(last) + "\tdesk_"
+                                     + str(block) + ".K\n")
+                            listed += 1
+
+                row = []
+                for last in sorted(members):
+                    if rng.random() < 0.9:
+                        row.append("<td>" + prefix + str(last) + "</td>")
+                if rng.random() < 0.2:
+                    extra = (172 << 24) + (16 << 16) + rng.randint(0, 1 << 20)
+                    row.append("<td>" + rid.int_to_ip(extra) + "</td>")
+                im.write("<tr>" + ''.join(row) + "</tr>\n")
+            im.write("</table></body></html>\n")
+    return listed
+
+'''
+################################################################################
+FAKE RESOLVER
+
+    Stands in for socket.gethostbyaddr().  Every seventh address has no
+    hostname; the rest are named after their address.  Each lookup sleeps for
+    'latency' milliseconds, like a (fast) DNS server would take.  The forward
+    lookups of --verify-dns are faked the same way.
+################################################################################
+'''
+def fake_gethostbyaddr (ip):
+    if ip.count('.') != 3:
+        raise socket.herror(1, "Unknown host")
+    time.sleep(latency / 1000.0)
+    if rid.ip_to_int(ip) % 7 == 0:
+        raise socket.herror(1, "Unknown host")
+    return ("host-" + ip.replace('.', '-') + ".bench.example.edu", [], [ip])
+
+# Stands in for socket.gethostbyname_ex() (for --verify-dns).  Every eleventh
+# hostname points somewhere else.
+def fake_gethostbyname_ex (name):
+    time.sleep(latency / 1000.0)
+    ip = name.split('.')[0][len("host-"):].replace('-', '.')
+    if rid.ip_to_int(ip) % 11 == 0:
+        ip = "192.0.2.1"
+    return (name, [], [ip])
+
+'''
+################################################################################
+RUN ONE SIZE
+
+    Points radmind_intermapper_diff.py at the generated files (through its own
+    option parser, so every setting has its normal default) and times each
+    stage.  Every stage runs 'repeat' times and the fastest time is kept.
+################################################################################
+'''
+def run_size (size, directory):
+    rm_path = os.path.join(directory, "config")
+    im_path = os.path.join(directory, "intermapper.html")
+
+    start = time.time()
+    listed = make_sources(size, rm_path, im_path)
+    print "Generated " + str(listed) + " Radmind addresses in " \
+          + "{:.2f}".format(time.time() - start) + " seconds."
+
+    configure(rm_path, im_path, directory)
+
+    stages = collections.OrderedDict()
+    stages['get_radmind'], rm_sorted = timed(rid.get_radmind)
+    rid.radmind_parser = 'classic'
+    stages['get_radmind_classic'], classic = timed(rid.get_radmind)
+    rid.radmind_parser = 'fast'
+    if classic != rm_sorted:
+        print "The fast and classic Radmind parsers disagree!"
+    stages['get_intermapper_file'], im_sorted = timed(rid.get_intermapper_file)
+    stages['differences'], (rm_diff, im_diff, common) = \
+        timed(rid.differences, rm_sorted, im_sorted)
+
+    sample = list(itertools.islice(itertools.chain(rm_diff, im_diff, common),
+                                   dns_sample))
+    real_gethostbyaddr = socket.gethostbyaddr
+    real_gethostbyname_ex = socket.gethostbyname_ex
+    socket.gethostbyaddr = fake_gethostbyaddr
+    socket.gethostbyname_ex = fake_gethostbyname_ex
+    try:
+        # The first pass goes past the cache (but fills it), the second is
+        # answered entirely from it.
+        rid.refresh_dns_cache = True
+        stages['resolve_hosts'], hostnames = timed(rid.resolve_hosts, sample)
+        rid.refresh_dns_cache = False
+        stages['resolve_hosts_cached'], hostnames = \
+            timed(rid.resolve_hosts, sample)
+        names = rid.find_hostnames(sample)
+        rid.refresh_dns_cache = True
+        stages['verify_hosts'], stale = timed(rid.verify_hosts, names)
+        rid.refresh_dns_cache = False
+    finally:
+        socket.gethostbyaddr = real_gethostbyaddr
+        socket.gethostbyname_ex = real_gethostbyname_ex
+
+    sections = [("Radmind items", 'radmind', rm_diff),
+                ("InterMapper items", 'intermapper', im_diff)]
+    found = rid.Results(rm_sorted, im_sorted, rm_diff, im_diff, common,
+                        hostnames, stale, rid.RADMIND_FILES, None)
+    for output_format in ['text', 'json', 'csv']:
+        rid.output_format = output_format
+        stages['write_report_' + output_format], ignored = \
+            timed(rid.write_report, sections, found, [NullSink()])
+
+    results = collections.OrderedDict()
+    results['version'] = rid.VERSION
+    results['python'] = platform.python_version()
+    results['time'] = time.time()
+    results['size'] = size
+    results['radmind_listed'] = rm_sorted.listed
+    results['intermapper_listed'] = im_sorted.listed
+    results['radmind_disparity'] = len(rm_diff)
+    results['intermapper_disparity'] = len(im_diff)
+    results['dns_sample'] = len(sample)
+    results['latency_ms'] = latency
+    results['stages'] = stages
+    return results
+
+def configure (rm_path, im_path, directory):
+    sys.argv = ['radmind_intermapper_diff.py', '-q',
+                '-r', rm_path,
+                '-i', im_path,
+                '--dns-cache', os.path.join(directory, "dns"),
+                '--log-path', directory]
+    rid.set_gvars()
+    rid.parse_options()
+
+    # Only warnings and errors are interesting here, and they go to stderr.
+    rid.logger = logging.getLogger("benchmark")
+    if not rid.logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setLevel(logging.WARNING)
+        rid.logger.addHandler(handler)
+    rid.logger.propagate = False
+    rid.load_dns_cache()
+    rid.reset_metrics()
+
+def timed (function, *args):
+    best = None
+    value = None
+    for i in range(0, max(1, repeat)):
+        start = time.time()
+        value = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (round(best, 6), value)
+
+# Throws away everything written to it.
+class NullSink (object):
+    def write (self, text):
+        pass
+
+'''
+################################################################################
+RESULTS
+
+    Each size's results go into output_file as a single line of JSON, so the
+    file is easy to append to and to read back.  When printing, each stage is
+    compared with the most recent earlier run of the same size, and anything
+    more than SLOWER times slower than it is flagged.
+################################################################################
+'''
+def load_previous ():
+    previous = {}
+    try:
+        with open(output_file) as f:
+            for line in f:
+                try:
+                    results = json.loads(line)
+                except ValueError:
+                    continue
+                previous[results.get('size')] = results
+    except IOError:
+        pass
+    return previous
+
+def save_results (results):
+    try:
+        with open(output_file, 'a') as f:
+            f.write(json.dumps(results) + "\n")
+    except IOError as e:
+        print "Could not save results to [" + output_file + "]: " + e.strerror
+
+def print_results (results, previous):
+    print
+    print "{} addresses (version {}, Python {})".format(results['size'],
+                                                        results['version'],
+                                                        results['python'])
+    if previous:
+        print "  compared with version {} on {}".format(
+            previous.get('version'),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(previous['time'])))
+    print "  {:24} {:>12} {:>12} {:>8}".format('stage', 'seconds', 'last',
+                                               'ratio')
+    for stage, seconds in results['stages'].items():
+        last = None
+        if previous:
+            last = previous.get('stages', {}).get(stage)
+        if last:
+            ratio = seconds / last
+            flag = ""
+            if ratio > SLOWER:
+                flag = "  slower"
+            print "  {:24} {:>12.6f} {:>12.6f} {:>7.2f}x{}".format(
+                stage, seconds, last, ratio, flag)
+        else:
+            print "  {:24} {:>12.6f} {:>12} {:>8}".format(stage, seconds,
+                                                          '-', '-')
+    print
+
+if __name__ == "__main__":
+    main()
@@ -24,8 +24,10 @@ Optional arguments:
   -x : lists all declared variables at the beginning of runtime
   -d : leaves the full DNS names intact (shortname.other.stuff.here)
   -e : specifies whether to send an email (usually used for defaults)
+  -E : list all exclusions (from the exclusions file) and quit
 
-  -r 'file'     : use 'file' as Radmind config file
+  -r 'file' ... : use these files as Radmind config files (each can be a glob,
+                  and -r can be given more than once)
   -i 'file'     : use 'file' as InterMapper address list
   -I 'address'  : use 'address' as InterMapper web address
   -o 'file'     : use 'file' as the output destination file
@@ -34,6 +36,49 @@ Optional arguments:
   --smtp-server 'address'   : use 'address' as the smtp server for sending mail
   --email-address 'address' : use 'address' as the recipient of the email
   --source-email 'address'  : use 'address' as the sender of the email
+  --smtp-starttls           : switch the SMTP connection to TLS before sending
+  --smtp-user 'user'        : log in to the SMTP server as 'user'
+  --smtp-password-file 'file' : read the SMTP password from 'file'
+  --email-retries #         : try sending email # more times if it fails
+  --routes 'file'           : also split the report up by subnet, as listed in
+                              'file' (see SUBNET ROUTES)
+  --exclusions 'file'       : never report or look up the addresses in 'file'
+  --radmind-parser 'name'   : read Radmind configs with the 'fast' parser
+                              (the default), the 'classic' one, or 'verify'
+                              (both, warning if they disagree)
+  --dns-workers #           : look up at most # hostnames at the same time
+  --resolver 'name'         : look up hostnames with the 'system' resolver
+                              (the default) or the built-in 'async' one
+  --nameservers 'list'      : send 'async' lookups to these servers
+  --dns-in-flight #         : keep at most # 'async' lookups going at once
+  --dns-rate #              : start at most # hostname lookups a second
+  --dns-timeout #           : give up on a single hostname after # seconds
+  --dns-deadline #          : give up on all hostnames after # seconds
+  --dns-cache 'file'        : use 'file' to cache hostnames between runs
+  --dns-ttl #               : trust cached hostnames for # seconds
+  --dns-negative-ttl #      : trust cached missing hostnames for # seconds
+  --dns-cache-size #        : keep at most # entries in the hostname cache
+  --verify-dns              : check that each hostname points back to its
+                              address, and report stale PTR records
+  --no-dns-cache            : don't read or write the hostname cache
+  --refresh-dns-cache       : look everything up again, then save the cache
+  --purge-dns-cache         : delete the hostname cache before starting
+  --snapshot 'file'         : keep the last InterMapper page in 'file'
+  --max-age #               : reuse the InterMapper snapshot for # seconds
+  --no-snapshot             : always download the whole InterMapper page
+  --since-last              : only report what has changed since the last run
+  --state-file 'file'       : keep the last run's results in 'file'
+  --format 'format'         : write the report as text (default), json, jsonl
+                              or csv
+  --daemon                  : keep running, checking again every interval
+  --interval #              : wait # seconds between checks with --daemon
+  --http-port #             : answer queries about the results over HTTP on
+                              port # (usually with --daemon)
+  --stats-file 'file'       : write each run's timings and counts to 'file'
+                              as JSON
+  --prometheus-file 'file'  : write each run's timings and counts to 'file'
+                              for the Prometheus textfile collector
+  --profile                 : run under cProfile and log where the time went
 
 Usage examples:
 
@@ -67,7 +112,6 @@ Usage examples:
     execution.
 
 UNIMPLEMENTED OPTIONS (TO-DO)
-  -E : list all built-in exclusions and quit
   -s # : only print one set of results:
      1 : Radmind
      2 : InterMapper
@@ -98,17 +142,42 @@ IMPORTS
 ################################################################################
 '''
 import argparse
+import array
+import BaseHTTPServer
+import bisect
+import collections
+import contextlib
+import cProfile
+import csv
 import getpass
+import glob
 import datetime
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import marshal
 import math
+import mmap
 import os
+import pstats
+import Queue
+import random
 import re
+import select
 import smtplib
 import socket
+import stat
+import StringIO
+import SocketServer
+import struct
 import subprocess
 import sys
+import tempfile
 import textwrap
+import threading
+import time
 import traceback
 import urllib2
 
@@ -126,20 +195,66 @@ def set_gvars ():
     '''###################'''
     # Change these for your local environment!  It'll make your life easier.
     global RADMIND_CONFIG       # Default location of Radmind config file
+    global RADMIND_PARSER       # 'fast', 'classic' or 'verify' (both)
     global INTERMAPPER_ADDRESS  # Default web address of InterMapper full list
     global SMTP_SERVER          # Default SMTP server address
     global DESTINATION_EMAIL    # Default send-to address for email
     global SOURCE_EMAIL         # Default sent-from address for email
+    global EMAIL_RETRIES        # Times to try sending email again
+    global EMAIL_BACKOFF        # Seconds before the first retry (then doubled)
     global LOG_PATH             # Location where the log will be written
     global LOG_FILE             # The name of the actual log file
+    global DNS_WORKERS          # Number of concurrent hostname lookups
+    global RESOLVER             # 'system' (gethostbyaddr) or 'async'
+    global RESOLV_CONF          # Where 'async' finds its nameservers
+    global DNS_IN_FLIGHT        # Most 'async' lookups waiting at once
+    global DNS_ATTEMPTS         # Times an 'async' lookup is sent
+    global DNS_RATE             # Most lookups started a second (0: no limit)
+    global DNS_START_WINDOW     # Lookups allowed at once before any answers
+    global DNS_TIMEOUT          # Seconds to wait for any single lookup
+    global DNS_DEADLINE         # Seconds to wait for all lookups together
+    global DNS_CACHE_FILE       # Where hostnames are cached between runs
+    global DNS_TTL              # Seconds a cached hostname is trusted
+    global DNS_NEGATIVE_TTL     # Seconds a cached "No DNS Entry" is trusted
+    global DNS_CACHE_SIZE       # Most entries the cache file will keep
+    global SNAPSHOT_FILE        # Where the last InterMapper page is kept
+    global MAX_AGE              # Seconds before the InterMapper page is stale
+    global STATE_FILE           # Where --since-last keeps the previous run
+    global INTERVAL             # Seconds between checks with --daemon
+    global EXCLUSIONS_FILE      # Addresses that are never reported
+    global HTTP_ADDRESS         # Interface the --http-port query server uses
+    global PROFILE_FILE         # Where --profile saves its raw cProfile data
 
     RADMIND_CONFIG      = "/radmind_server_root/radmind/config"
+    RADMIND_PARSER      = "fast"
     INTERMAPPER_ADDRESS = "https://intermapper.address/~admin/full_screen.html"
     SMTP_SERVER         = "smtp@yourdomain"
     DESTINATION_EMAIL   = "root@localhost"
     SOURCE_EMAIL        = "radmind_intermapper_diff.py@localhost"
+    EMAIL_RETRIES       = 3
+    EMAIL_BACKOFF       = 10.0
     LOG_PATH            = "/var/log/"
     LOG_FILE            = "radmind_intermapper_diff.log"
+    DNS_WORKERS         = 32
+    RESOLVER            = "system"
+    RESOLV_CONF         = "/etc/resolv.conf"
+    DNS_IN_FLIGHT       = 1000
+    DNS_ATTEMPTS        = 3
+    DNS_RATE            = 0
+    DNS_START_WINDOW    = 16
+    DNS_TIMEOUT         = 5.0
+    DNS_DEADLINE        = 600.0
+    DNS_CACHE_FILE      = "/var/db/radmind_intermapper_diff.dns"
+    DNS_TTL             = 86400
+    DNS_NEGATIVE_TTL    = 3600
+    DNS_CACHE_SIZE      = 100000
+    SNAPSHOT_FILE       = "/var/db/radmind_intermapper_diff.im"
+    MAX_AGE             = 0
+    STATE_FILE          = "/var/db/radmind_intermapper_diff.state"
+    INTERVAL            = 900
+    EXCLUSIONS_FILE     = "/radmind_server_root/radmind/exclusions"
+    HTTP_ADDRESS        = "127.0.0.1"
+    PROFILE_FILE        = "/var/db/radmind_intermapper_diff.prof"
 
     ''' DON'T CHANGE THESE UNLESS YOU KNOW WHAT YOU'RE DOING!!! '''
     '''#########################################################'''
@@ -149,21 +264,72 @@ def set_gvars ():
     global RM_3         # Radmind three-deep match: 'a.b.c.'
     global RM_FIRST     # Radmind first match: d in a.b.c.<d-e>
     global RM_LAST      # Radmind last match: e in a.b.c.<d-e>
+    global RM_LINE      # Radmind fast parser: any line it's interested in
+
+    # ADDRESS STORAGE
+    global ADDRESS_TYPE # array typecode holding one 32-bit IPv4 address
+    global ADDRESS_CHARACTERS   # Every character that can be in an address
+    global CHUNK_SIZE   # Bytes read at a time from InterMapper lists
+    global RADMIND_WORKERS  # Radmind config files read at the same time
+    global INCLUDE      # Starts a line that pulls in another Radmind config
 
     IP_PATTERN  = re.compile('\d+\.\d+\.\d+\.\d+')
     RM_PATTERN  = re.compile('\d+\.\d+\.\d+\.[^\s)]+')
     RM_3        = re.compile('\d+\.\d+\.\d+\.')
     RM_FIRST    = re.compile('<(\d+)')
     RM_LAST     = re.compile('(\d+)>')
+    # a.b.c.d or a.b.c.<d-e>, written plainly, then anything else that starts
+    # like an address, then @include lines (indented or not, as the classic
+    # parser allows).  (Bytes, to search an mmap.)
+    RM_LINE     = re.compile(br'^(?:((?:(?:0|[1-9]\d{0,2})\.){3})'
+                             br'(?:(0|[1-9]\d{0,2})|<(\d+)-(\d+)>)(?=[\s)]|$)'
+                             br'|(\d+\.\d+\.\d+\.[^\s)]+)'
+                             br'|[^\S\n]*@include[^\S\n]+(\S+))', re.M)
+
+    if array.array('I').itemsize >= 4:
+        ADDRESS_TYPE = 'I'
+    else:
+        ADDRESS_TYPE = 'L'
+    ADDRESS_CHARACTERS = '0123456789.'
+    CHUNK_SIZE  = 64 * 1024
+    RADMIND_WORKERS = 8
+    INCLUDE     = '@include'
 
     # OTHER
     # DON'T CHANGE THESE
     global VERSION      # Current version of the script
-    global OUTPUT_TEXT  # Stores all the text (so it can be outputted multiple
-                        # times easily)
-
-    VERSION     = "2.2.4"
-    OUTPUT_TEXT = ''
+    global FILE_BUFFER  # Write buffer size for the output file
+    global REPORT_FIELDS    # Fields (in order) of each --format record
+    global HELD_CONSOLE # HeldConsole while both lists are being fetched at once
+    global PUBLISHED    # Latest results served by the query server
+    global METRICS      # Timings and counts for the current run
+    global METRICS_LOCK # Guards METRICS against the worker threads
+    global PROGRESS_INTERVAL    # Fewest seconds between progress redraws
+    global ACTIVE_PROGRESS  # Progress bars currently on the screen
+    global PROGRESS_LOCK    # Keeps progress bars from drawing over each other
+    global ROUTES       # RouteTable from --routes, or None
+    global EXCLUSIONS   # AddressRanges of every excluded address
+    global RADMIND_FILES    # RadmindFile for each Radmind config read
+    global REVERSE_LOOKUP   # How hostnames are looked up
+    global FORWARD_LOOKUP   # How --verify-dns looks up their addresses
+
+    VERSION     = "2.22.2"
+    FILE_BUFFER = 64 * 1024
+    REPORT_FIELDS = ['ip', 'ip_int', 'hostname', 'dns_status', 'sources',
+                     'side', 'section', 'radmind_files']
+    HELD_CONSOLE = None
+    PUBLISHED   = None
+    METRICS     = collections.OrderedDict()
+    METRICS_LOCK = threading.Lock()
+    PROGRESS_INTERVAL = 0.1
+    ACTIVE_PROGRESS = []
+    PROGRESS_LOCK = threading.Lock()
+    ROUTES      = None
+    EXCLUSIONS  = None
+    RADMIND_FILES = []
+    REVERSE_LOOKUP = Lookup('dns', 12, ptr_qname, int_to_ip, lookup_host)
+    FORWARD_LOOKUP = Lookup('verify', 1, a_qname, lambda name: a_qname(name)
+                            + '.', lookup_addresses)
 
 
 '''
@@ -204,6 +370,16 @@ user, and can optionally be stored in a text file or emailed.'''
     switches.append(['-x, --explicit', "show all declared variables at run-time (overrides -q)"])
     switches.append(['-d, --dns-full', "leave the full DNS names intact"])
     switches.append(['-e, --email', "send an email to the default address"])
+    switches.append(['-E, --list-exclusions', "list all exclusions and quit"])
+    switches.append(['--since-last', "only report what has changed since the last --since-last run"])
+    switches.append(['--daemon', "keep running, checking again every --interval seconds and only reporting changes"])
+    switches.append(['--no-dns-cache', "don't read or write the hostname cache"])
+    switches.append(['--refresh-dns-cache', "look up every hostname again, then save the cache"])
+    switches.append(['--purge-dns-cache', "delete the hostname cache before starting"])
+    switches.append(['--verify-dns', "check that each hostname points back to its address"])
+    switches.append(['--no-snapshot', "always download the whole InterMapper page"])
+    switches.append(['--profile', "run under cProfile, log the slowest calls and save the raw data"])
+    switches.append(['--smtp-starttls', "switch the SMTP connection to TLS (STARTTLS) before sending"])
 
     switches_length = 0
     for item in switches:
@@ -211,14 +387,39 @@ user, and can optionally be stored in a text file or emailed.'''
             switches_length = len(item[0])
 
     positionals = []
-    positionals.append(['-r, --radmind-file \'file\'', "use 'file' as the Radmind configuration file"])
+    positionals.append(['-r, --radmind-file \'file\' ...', "use these Radmind config files (globs allowed; -r can be repeated)"])
     positionals.append(['-i, --intermapper-file \'file\'', "use 'file' as the InterMapper list of addresses"])
     positionals.append(['-I, --intermapper-address \'address\'', "use 'address' as the InterMapper connection address (to get freshest results)"])
     positionals.append(['-o, --output \'file\'', "output the results to 'file'"])
     positionals.append(['    --smtp-server \'address\'', "set the SMTP server to 'address' (for sending mail)"])
-    positionals.append(['    --email-address \'address\'', "send output in an email to 'address'"])
+    positionals.append(['    --email-address \'address\'', "send output in an email to 'address' (separate more than one with commas)"])
     positionals.append(['    --source-email \'address\'', "send output in an email from 'address'"])
+    positionals.append(['    --smtp-user \'user\'', "log in to the SMTP server as 'user'"])
+    positionals.append(['    --smtp-password-file \'file\'', "read the password for --smtp-user from the first line of 'file'"])
+    positionals.append(['    --email-retries #', "if sending email fails, try # more times, waiting longer each time"])
+    positionals.append(['    --exclusions \'file\'', "never report (or look up) the addresses listed in 'file'"])
+    positionals.append(['    --routes \'file\'', "also send each team the part of the report for its own subnets, as listed in 'file'"])
     positionals.append(['    --log-path \'path\'', "send logging output to a file in 'path'"])
+    positionals.append(['    --dns-workers #', "look up at most # hostnames at the same time"])
+    positionals.append(['    --radmind-parser \'name\'', "read Radmind configs with the 'fast' parser (the default), the 'classic' one, or 'verify' (both, warning if they disagree)"])
+    positionals.append(['    --resolver \'name\'', "look up hostnames with the 'system' resolver (the default) or the built-in 'async' one (see ASYNC DNS CLIENT)"])
+    positionals.append(['    --nameservers \'list\'', "send 'async' lookups to these comma-separated servers (default: those in /etc/resolv.conf)"])
+    positionals.append(['    --dns-in-flight #', "keep at most # 'async' lookups going at the same time"])
+    positionals.append(['    --dns-rate #', "start at most # hostname lookups a second (default 0, no limit)"])
+    positionals.append(['    --dns-timeout #', "give up on a single hostname lookup after # seconds"])
+    positionals.append(['    --dns-deadline #', "give up on all remaining hostname lookups after # seconds"])
+    positionals.append(['    --dns-cache \'file\'', "cache hostnames in 'file' between runs"])
+    positionals.append(['    --dns-ttl #', "trust cached hostnames for # seconds"])
+    positionals.append(['    --dns-negative-ttl #', "trust cached 'No DNS Entry' results for # seconds"])
+    positionals.append(['    --dns-cache-size #', "keep at most # entries in the hostname cache"])
+    positionals.append(['    --snapshot \'file\'', "keep the last InterMapper page in 'file' and only download it again if it has changed"])
+    positionals.append(['    --max-age #', "don't contact InterMapper at all if the snapshot is less than # seconds old"])
+    positionals.append(['    --state-file \'file\'', "keep the last run's results in 'file' for --since-last"])
+    positionals.append(['    --format \'format\'', "write the report as 'text' (the default), 'json', 'jsonl' or 'csv'"])
+    positionals.append(['    --interval #', "wait # seconds between checks with --daemon"])
+    positionals.append(['    --http-port #', "answer queries about the latest results over HTTP on port # (see QUERY SERVER)"])
+    positionals.append(['    --stats-file \'file\'', "write each run's timings and counts to 'file' as JSON"])
+    positionals.append(['    --prometheus-file \'file\'', "write each run's timings and counts to 'file' for the Prometheus textfile collector"])
 
     positionals_length = 0
     for item in positionals:
@@ -297,21 +498,29 @@ MAIN
     1.1.      Set the global variables
     1.2.      Parse for command line options
     1.3.      Build logging systems
-    2.      Get address lists
+    1.4.      Load the hostname cache, previous state, subnet routes and
+              exclusions (-E lists the exclusions and quits here)
+    (Each run's timings and counts are logged at the end; see METRICS.)
+    (With --daemon, steps 2 through 9 are repeated every interval.)
+    2.      Get address lists (both at the same time)
     2.1.      Radmind addresses
     2.2.      InterMapper addresses
-    3.      Get hostnames for IPs
-    3.1.      Radmind hostnames
-    3.2.      InterMapper hostnames
-    4.      Sort IP addresses
-    4.1.      Radmind addresses
-    4.2.      InterMapper addresses
-    5.      Find disparities
-    5.1.      Radmind positive disparity (Radmind has, InterMapper doesn't)
-    5.2.      InterMapper positive dispairty (InterMapper has, Radmind doesn't)
-    6.      File output
-    7.      Email output
-    8.      Console output
+    3.      Sort IP addresses (done by the loaders)
+    3.1.      Radmind addresses (merged ranges)
+    3.2.      InterMapper addresses
+    3.3.      Drop excluded addresses from both
+    4.      Find disparities (both sides, and the overlap, in a single pass)
+    4.1.      Radmind positive disparity (Radmind has, InterMapper doesn't)
+    4.2.      InterMapper positive dispairty (InterMapper has, Radmind doesn't)
+    4.3.      Addresses both lists have in common
+    5.      Get hostnames for IPs (each unique address is looked up once)
+    5.1.      Radmind hostnames
+    5.2.      InterMapper hostnames
+    6.      Changes since the last run (only with --since-last)
+    7.      Write the report (file, email and console, all in one pass)
+    7.1.      Each team's part of the report (only with --routes)
+    8.      Email output (every message over one connection)
+    9.      Full listing (only with -f)
 ################################################################################
 '''
 def main ():
@@ -319,80 +528,462 @@ def main ():
     set_gvars()
     parse_options()
     build_loggers()
+    load_dns_cache()
+    load_state()
+    load_routes()
+    load_exclusions()
+    if list_exclusions:
+        print_exclusions()
+        sys.exit(0)
+    if http_port:
+        start_query_server()
 
-    # Get the list of Radmind IPs
-    rm_list = get_radmind()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if daemon:
+            run_daemon()
+        else:
+            run_once()
+    finally:
+        if profile:
+            profiler.disable()
+            save_profile(profiler)
 
-    # Get the list of InterMapper IPs
-    # If the user specifies a file to get them from, use that.  Otherwise,
-    # attempt to connect to im_address and use a new version.
-    if im_file:
-        im_list = get_intermapper_file()
-    else:
-        im_list = get_intermapper_web()
-
-    # Get the hostnames for Radmind IPs
-    rm_stuff = {}
-    for i in range(0, len(rm_list)):
-        update_progress(i/float(len(rm_list)))
-        item = rm_list[i]
-        rm_stuff[item] = str(get_host(item)).replace("'", "")
-    update_progress()
-    logger.info("Radmind hostnames acquired.")
+'''
+################################################################################
+RUN ONCE
 
-    # Get the hostnames for InterMapper IPs
-    im_stuff = {}
-    for i in range(0, len(im_list)):
-        update_progress(i/float(len(im_list)))
-        item = im_list[i]
-        im_stuff[item] = str(get_host(item)).replace("'", "")
-    update_progress()
-    logger.info("InterMapper hostnames acquired.")
+    Steps 2 through 9 of the program overview above.  Returns the Results of
+    this run, which can be handed back in as 'previous' on the next run (see
+    DAEMON MODE) so that work whose inputs haven't changed isn't done again:
+    if neither list of addresses has changed, the disparities from last time
+    are reused, and if the disparities (and their hostnames) are the same as
+    last time, no report is sent anywhere.
 
-    '''
-    Sort the IP addresses.
-
-    The following sort method was detailed in an answer by Ferdinand Beyer to
-    the question "How to sort IP addresses stored in dictionary in Python?" at:
-        http://stackoverflow.com/questions/6545023/how-to-sort-ip-addresses-
-        stored-in-dictionary-in-python
-    It returns the values with the IP addresses sorted properly, and keeps
-    their hostnames attached.
-    '''
-    rm_sorted = []
-    im_sorted = []
-    try:
-        rm_sorted = sorted(rm_stuff.items(),
-                           key=lambda item: socket.inet_aton(item[0]))
-        im_sorted = sorted(im_stuff.items(),
-                           key=lambda item: socket.inet_aton(item[0]))
-    except:
-        logger.error("IP sorting failed")
-        traceback.print_exc(file=sys.stdout)
-    logger.info("IP addresses sorted.")
+    With --verify-dns, the hostnames are checked against their A records (see
+    VERIFY HOSTNAMES) before anything is reported.
 
-    # Find the Radmind positive disparities
-    rm_diff = differences(rm_sorted, im_sorted)
-    logger.info("Found Radmind positive disparity.")
-    # Find the InterMapper positive disparities
-    im_diff = differences(im_sorted, rm_sorted)
-    logger.info("Found InterMapper positive disparity.")
+    Each run's timings and counts are collected along the way (see METRICS)
+    and written out when it finishes, whether it succeeded or not.
+################################################################################
+'''
+Results = collections.namedtuple('Results', ['rm_sorted', 'im_sorted',
+                                             'rm_diff', 'im_diff', 'common',
+                                             'hostnames', 'stale',
+                                             'radmind_files', 'signature'])
+
+def run_once (previous=None):
+    reset_metrics()
+    succeeded = False
+    try:
+        with timed('run'):
+            results = run_stages(previous)
+        succeeded = True
+    finally:
+        set_metric('success', int(succeeded))
+        write_metrics()
+    return results
+
+def run_stages (previous):
+    global PREVIOUS_STATE
+
+    # Get the lists of Radmind and InterMapper IPs at the same time.  Both come
+    # back already sorted (as AddressRanges), without any duplicates.
+    with timed('load_sources'):
+        rm_listed, im_listed = load_sources()
+    # Kept with this run's results, so the report (and the query server) never
+    # says where an address came from using some other run's Radmind configs.
+    files = RADMIND_FILES
+    logger.info("IP addresses sorted.")
+    set_metric('radmind_listed', rm_listed.listed)
+    set_metric('radmind_addresses', len(rm_listed))
+    set_metric('radmind_ranges', len(rm_listed.starts))
+    set_metric('intermapper_listed', im_listed.listed)
+    set_metric('intermapper_addresses', len(im_listed))
+
+    # Excluded addresses are dropped before anything else happens to them, so
+    # they are never looked up or reported.
+    rm_sorted = exclude(rm_listed, EXCLUSIONS)
+    im_sorted = exclude(im_listed, EXCLUSIONS)
+    if EXCLUSIONS:
+        rm_excluded = len(rm_listed) - len(rm_sorted)
+        im_excluded = len(im_listed) - len(im_sorted)
+        set_metric('radmind_excluded', rm_excluded)
+        set_metric('intermapper_excluded', im_excluded)
+        logger.info("Excluded " + str(rm_excluded) + " Radmind and "
+                    + str(im_excluded) + " InterMapper addresses.")
+
+    # Find the Radmind and InterMapper positive disparities in one pass.
+    if (previous and rm_sorted == previous.rm_sorted
+            and im_sorted == previous.im_sorted):
+        rm_diff = previous.rm_diff
+        im_diff = previous.im_diff
+        common = previous.common
+        logger.info("Address lists are unchanged; reusing disparities.")
+    else:
+        with timed('differences'):
+            rm_diff, im_diff, common = differences(rm_sorted, im_sorted)
+        logger.info("Found Radmind positive disparity.")
+        logger.info("Found InterMapper positive disparity.")
+        logger.info(str(len(common)) + " addresses are in both lists.")
+
+    # Get the hostnames for every address.  Most addresses show up in both
+    # lists (and some show up in the Radmind list more than once), so each one
+    # is only looked up once and both sides share the same dictionary.
+    set_metric('radmind_disparity', len(rm_diff))
+    set_metric('intermapper_disparity', len(im_diff))
+    set_metric('common', len(common))
+    with timed('dns'):
+        names = find_hostnames(itertools.chain(rm_diff, im_diff, common))
+        hostnames = display_hosts(names)
+    stale = {}
+    if verify_dns:
+        with timed('verify'):
+            stale = verify_hosts(names)
+        logger.info(str(len(stale)) + " stale PTR records found.")
+    save_dns_cache()
+    saved = rm_sorted.listed + im_sorted.listed - len(hostnames)
+    logger.info("Hostnames acquired: " + str(len(hostnames))
+                + " addresses, " + str(saved) + " duplicate lookups skipped.")
+    logger.info("Radmind hostnames acquired.")
+    logger.info("InterMapper hostnames acquired.")
 
-    prep_output (rm_diff, im_diff)
+    state = build_state(im_listed, rm_diff, im_diff, hostnames, files)
+    results = Results(rm_sorted, im_sorted, rm_diff, im_diff, common,
+                      hostnames, stale, files,
+                      (state['rm_diff'], state['im_diff'], state['hostnames'],
+                       sorted(stale.items())))
+
+    # In --since-last mode, only report what has changed since the last run.
+    # The addresses that have gone away are reported with last run's
+    # hostnames, which aren't part of this run's results.
+    report_results = results
+    if since_last:
+        sections, names = changes_since_last(rm_diff, im_diff, hostnames)
+        report_results = results._replace(hostnames=names)
+        save_state(state)
+    else:
+        sections = [("Radmind items", 'radmind', rm_diff),
+                    ("InterMapper items", 'intermapper', im_diff)]
+    PREVIOUS_STATE = state
+    publish(results, state)
+
+    if previous and results.signature == previous.signature:
+        logger.info("Disparity is unchanged; not reporting it again.")
+        return results
+
+    with timed('report'):
+        report(report_results, sections)
+    return results
+
+# The report is rendered once, with each line going straight out to every
+# destination (file, email, console) at the same time.
+def report (results, sections):
+    sinks = []
+    if out_file:
+        report_file = open_file_output()
+        sinks.append(report_file)
+    if email:
+        email_body = StringIO.StringIO()
+        email_body.write(report_header())
+        sinks.append(email_body)
+    if not quiet and not full:
+        if output_format == 'text':
+            print "\n"
+        sinks.append(sys.stdout)
+    write_report (sections, results, sinks)
 
     if out_file:
-        file_output ()
+        close_file_output (report_file)
 
+    messages = []
     if email:
-        send_email ()
+        messages.append(email_message(email_body.getvalue(),
+                                      email_recipients()))
+    if ROUTES:
+        messages.extend(team_reports(sections, results))
+
+    # The email goes out in the background while the console is finished off.
+    if messages:
+        mail = BackgroundTask(send_email, messages)
+
+    # The full listing only ever goes to the console.  Its addresses aren't
+    # all on one side of the disparity, so each one's side is worked out
+    # separately (see address_side()).
+    if not quiet and full:
+        if output_format == 'text':
+            print "\n"
+        write_report ([("Radmind items", None, results.rm_sorted),
+                       ("InterMapper items", None, results.im_sorted)],
+                      results, [sys.stdout])
+
+    if messages:
+        wait_for_email(mail, messages)
 
-    if not quiet:
-        print "\n"
-        if full:
-            prep_output (rm_sorted, im_sorted)
-            print (OUTPUT_TEXT)
+'''
+################################################################################
+DAEMON MODE
+
+    With --daemon, the program stays running and calls run_once() every
+    'interval' seconds, keeping everything from the previous run in memory: the
+    hostname cache, the addresses and fingerprints of the source files (so an
+    unchanged Radmind config or InterMapper file isn't parsed again; the
+    InterMapper web page is only downloaded again if it has changed), and the
+    disparities themselves.  Reports only go out when the disparity changes.
+
+    A run that fails (say, InterMapper can't be reached) is logged and tried
+    again at the next interval rather than stopping the daemon.
+################################################################################
+'''
+def run_daemon ():
+    logger.info("Running as a daemon; checking every " + str(interval)
+                + " seconds.")
+    previous = None
+    while True:
+        started = time.time()
+        try:
+            previous = run_once(previous)
+        except SystemExit as e:
+            logger.error("Check failed (exit code " + str(e.code)
+                         + "); trying again in " + str(interval) + " seconds.")
+        time.sleep(max(0, interval - (time.time() - started)))
+
+'''
+################################################################################
+QUERY SERVER
+
+    With --http-port, a small HTTP server runs on its own threads next to the
+    rest of the program (most usefully --daemon) and answers questions about
+    the latest results without another run:
+
+        GET /disparity      every address in the current disparity, as the
+                            same records --format json writes
+        GET /ip/a.b.c.d     one address: which lists it's in, which side of
+                            the disparity (if any) and its hostname
+
+    Looking up an address only searches the AddressRanges (a binary search)
+    and the hostname dictionary, so it's cheap however long the lists are.
+    Every answer carries an ETag that changes only when the results do, so a
+    client that sends If-None-Match gets a bodiless 304 until something
+    changes.  Until the first run has finished, every query gets a 503.
+
+    Each run replaces PUBLISHED in a single assignment, so a query always sees
+    one run's results or the next, never a mix of the two.
+################################################################################
+'''
+Published = collections.namedtuple('Published', ['results', 'etag', 'cache'])
+
+def publish (results, state):
+    global PUBLISHED
+    if not http_port:
+        return
+    if PUBLISHED and results.signature == PUBLISHED.results.signature \
+            and results.rm_sorted == PUBLISHED.results.rm_sorted \
+            and results.im_sorted == PUBLISHED.results.im_sorted \
+            and file_ranges(results) == file_ranges(PUBLISHED.results):
+        etag = PUBLISHED.etag
+    else:
+        digest = hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+        etag = '"' + digest + '"'
+    PUBLISHED = Published(results, etag, {})
+
+# Which addresses each Radmind config gave, since the records say which configs
+# list each address.
+def file_ranges (results):
+    return [(radmind_file.path, radmind_file.ranges)
+            for radmind_file in results.radmind_files]
+
+def start_query_server ():
+    try:
+        server = QueryServer((HTTP_ADDRESS, http_port), QueryHandler)
+    except socket.error as e:
+        logger.error("Couldn't start the query server on port "
+                     + str(http_port) + ": " + str(e))
+        sys.exit(22)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Answering queries on http://" + HTTP_ADDRESS + ":"
+                + str(http_port) + "/")
+
+class QueryServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class QueryHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET (self):
+        published = PUBLISHED
+        if not published:
+            self.send_json(503, {'error': "no results yet"})
+            return
+
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path == '/disparity':
+            body = published.cache.get(path)
+            if body is None:
+                body = disparity_body(published.results)
+                published.cache[path] = body
+        elif path.startswith('/ip/') and IP_PATTERN.match(path[4:]):
+            try:
+                body = json.dumps(address_record(published.results,
+                                                 ip_to_int(path[4:])))
+            except (socket.error, struct.error):
+                self.send_json(400, {'error': "not an IPv4 address"})
+                return
         else:
-            print (OUTPUT_TEXT)
+            self.send_json(404, {'error': "unknown query"})
+            return
+
+        if published.etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', published.etag)
+            self.end_headers()
+            return
+        self.send_json(200, body, published.etag)
+
+    def send_json (self, code, body, etag=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        logger.debug("Query from " + self.client_address[0] + ": "
+                     + (format % args))
+
+def disparity_body (results):
+    sections = [("Radmind items", 'radmind', results.rm_diff),
+                ("InterMapper items", 'intermapper', results.im_diff)]
+    return ''.join(json_lines(report_records(sections, results)))
+
+def address_record (results, address):
+    hostname = results.hostnames.get(address)
+    if hostname is None:
+        status = None
+    else:
+        hostname, status = hostname_status(hostname)
+        if status == 'ok' and address in results.stale:
+            status = 'stale'
+
+    record = collections.OrderedDict()
+    record['ip'] = int_to_ip(address)
+    record['ip_int'] = address
+    record['hostname'] = hostname
+    record['dns_status'] = status
+    record['sources'] = address_sources(results, address)
+    record['side'] = address_side(results, address)
+    record['radmind_files'] = radmind_files(results, address)
+    return record
+
+# Which lists have 'address'.
+def address_sources (results, address):
+    return [name for name, listed in [('radmind', results.rm_sorted),
+                                      ('intermapper', results.im_sorted)]
+            if address in listed]
+
+# Which side of the disparity 'address' is on: 'radmind', 'intermapper',
+# 'both' (it's in both lists) or None (it's in neither).
+def address_side (results, address):
+    if address in results.rm_diff:
+        return 'radmind'
+    if address in results.im_diff:
+        return 'intermapper'
+    if address in results.common:
+        return 'both'
+    return None
+
+'''
+################################################################################
+METRICS
+
+    Every run records how long each stage took (as <stage>_seconds) and how
+    much it handled: addresses listed and kept, the sizes of the disparities,
+    hostname lookups and cache hits, misses and timeouts, and the bytes read
+    from each source.  These go to the log file after every run, and can also
+    be written to stats_file (JSON) or prometheus_file (the text format read by
+    the Prometheus node_exporter's textfile collector).  Both files are
+    replaced in a single rename, so nothing ever reads half of one.
+
+    Counts can be bumped from any thread, so they're kept under METRICS_LOCK.
+
+    --profile runs everything under cProfile (which only sees the main thread,
+    not the hostname lookups or the Radmind reader), logs the slowest calls
+    and saves the raw data to PROFILE_FILE for pstats or a viewer.
+################################################################################
+'''
+def reset_metrics ():
+    global METRICS
+    with METRICS_LOCK:
+        METRICS = collections.OrderedDict()
+
+def set_metric (name, value):
+    with METRICS_LOCK:
+        METRICS[name] = value
+
+def count (name, amount=1):
+    with METRICS_LOCK:
+        METRICS[name] = METRICS.get(name, 0) + amount
+
+@contextlib.contextmanager
+def timed (stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        set_metric(stage + '_seconds', round(time.time() - start, 6))
+
+def write_metrics ():
+    with METRICS_LOCK:
+        metrics = METRICS.copy()
+    logger.info("Metrics: " + ", ".join(name + "=" + str(metrics[name])
+                                        for name in metrics))
+
+    if stats_file:
+        stats = collections.OrderedDict()
+        stats['version'] = VERSION
+        stats['finished'] = time.time()
+        stats.update(metrics)
+        write_metrics_file(stats_file, json.dumps(stats, indent=2) + "\n")
+
+    if prometheus_file:
+        lines = []
+        metrics['last_run_timestamp_seconds'] = int(time.time())
+        for name in metrics:
+            metric = "radmind_intermapper_diff_" + name
+            lines.append("# TYPE " + metric + " gauge\n")
+            lines.append(metric + " " + str(metrics[name]) + "\n")
+        write_metrics_file(prometheus_file, ''.join(lines))
+
+# Other programs (the node_exporter, say) read these, so they're left readable
+# by everyone (see SAVED FILES).
+def write_metrics_file (path, text):
+    try:
+        with replace_file(path, public=True) as f:
+            f.write(text)
+    except (IOError, OSError) as e:
+        logger.warning("Could not write metrics to [" + path + "]: "
+                       + str(e.strerror))
+
+def save_profile (profiler):
+    summary = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=summary)
+    stats.sort_stats('cumulative').print_stats(25)
+    logger.info("Profile:\n" + summary.getvalue())
+    try:
+        # The same as stats.dump_stats(), but through a private temporary file.
+        with replace_file(PROFILE_FILE, 'wb') as f:
+            marshal.dump(stats.stats, f)
+        logger.info("Saved profile to [" + PROFILE_FILE + "].")
+    except (IOError, OSError) as e:
+        logger.warning("Could not save profile to [" + PROFILE_FILE + "]: "
+                       + str(e.strerror))
 
 '''
 ################################################################################
@@ -408,15 +999,50 @@ PARSE ARGUMENTS
         -x, --explicit
         -d, --dns-full
         -e, --email
+        -E, --list-exclusions
 
-        -r, --radmind-file 'file'
+        -r, --radmind-file 'file' ...
         -i, --intermapper-file 'file'
         -I, --intermapper-address 'address'
         -o, --output 'file'
             --smtp-server
             --email-address
             --source-email
+            --smtp-starttls
+            --smtp-user
+            --smtp-password-file
+            --email-retries
+            --routes
+            --exclusions
             --log-path
+            --dns-workers
+            --radmind-parser
+            --resolver
+            --nameservers
+            --dns-in-flight
+            --dns-rate
+            --dns-timeout
+            --dns-deadline
+            --dns-cache
+            --dns-ttl
+            --dns-negative-ttl
+            --dns-cache-size
+            --no-dns-cache
+            --refresh-dns-cache
+            --purge-dns-cache
+            --verify-dns
+            --snapshot
+            --max-age
+            --no-snapshot
+            --since-last
+            --state-file
+            --format
+            --daemon
+            --interval
+            --http-port
+            --stats-file
+            --prometheus-file
+            --profile
 ################################################################################
 '''
 def parse_options ():
@@ -442,10 +1068,38 @@ def parse_options ():
     parser.add_argument("-e", "--email",
                         dest='email',
                         action='store_true')
+    parser.add_argument("-E", "--list-exclusions",
+                        dest='list_exclusions',
+                        action='store_true')
+    parser.add_argument("--since-last",
+                        dest='since_last',
+                        action='store_true')
+    parser.add_argument("--daemon",
+                        dest='daemon',
+                        action='store_true')
+    parser.add_argument("--no-dns-cache",
+                        dest='no_dns_cache',
+                        action='store_true')
+    parser.add_argument("--refresh-dns-cache",
+                        dest='refresh_dns_cache',
+                        action='store_true')
+    parser.add_argument("--purge-dns-cache",
+                        dest='purge_dns_cache',
+                        action='store_true')
+    parser.add_argument("--verify-dns",
+                        dest='verify_dns',
+                        action='store_true')
+    parser.add_argument("--no-snapshot",
+                        dest='no_snapshot',
+                        action='store_true')
+    parser.add_argument("--profile",
+                        dest='profile',
+                        action='store_true')
 
     parser.add_argument("-r", "--radmind-file",
-                        dest='rm_file',
-                        default=RADMIND_CONFIG)
+                        dest='rm_files',
+                        nargs='+',
+                        action='append')
     parser.add_argument("-i", "--intermapper-file",
                         dest='im_file',
                         default=None)
@@ -464,13 +1118,110 @@ def parse_options ():
     parser.add_argument("--source-email",
                         dest='source_email',
                         default=SOURCE_EMAIL)
+    parser.add_argument("--smtp-starttls",
+                        dest='smtp_starttls',
+                        action='store_true')
+    parser.add_argument("--smtp-user",
+                        dest='smtp_user',
+                        default=None)
+    parser.add_argument("--smtp-password-file",
+                        dest='smtp_password_file',
+                        default=None)
+    parser.add_argument("--email-retries",
+                        dest='email_retries',
+                        type=int,
+                        default=EMAIL_RETRIES)
+    parser.add_argument("--routes",
+                        dest='routes_file',
+                        default=None)
+    parser.add_argument("--exclusions",
+                        dest='exclusions_file',
+                        default=None)
     parser.add_argument("--log-path",
                         dest='log_dest',
                         default=LOG_PATH)
+    parser.add_argument("--radmind-parser",
+                        dest='radmind_parser',
+                        choices=['fast', 'classic', 'verify'],
+                        default=RADMIND_PARSER)
+    parser.add_argument("--resolver",
+                        dest='resolver',
+                        choices=['system', 'async'],
+                        default=RESOLVER)
+    parser.add_argument("--nameservers",
+                        dest='nameservers',
+                        default=None)
+    parser.add_argument("--dns-in-flight",
+                        dest='dns_in_flight',
+                        type=int,
+                        default=DNS_IN_FLIGHT)
+    parser.add_argument("--dns-rate",
+                        dest='dns_rate',
+                        type=float,
+                        default=DNS_RATE)
+    parser.add_argument("--dns-workers",
+                        dest='dns_workers',
+                        type=int,
+                        default=DNS_WORKERS)
+    parser.add_argument("--dns-timeout",
+                        dest='dns_timeout',
+                        type=float,
+                        default=DNS_TIMEOUT)
+    parser.add_argument("--dns-deadline",
+                        dest='dns_deadline',
+                        type=float,
+                        default=DNS_DEADLINE)
+    parser.add_argument("--dns-cache",
+                        dest='dns_cache_file',
+                        default=DNS_CACHE_FILE)
+    parser.add_argument("--dns-ttl",
+                        dest='dns_ttl',
+                        type=float,
+                        default=DNS_TTL)
+    parser.add_argument("--dns-negative-ttl",
+                        dest='dns_negative_ttl',
+                        type=float,
+                        default=DNS_NEGATIVE_TTL)
+    parser.add_argument("--dns-cache-size",
+                        dest='dns_cache_size',
+                        type=int,
+                        default=DNS_CACHE_SIZE)
+    parser.add_argument("--snapshot",
+                        dest='snapshot_file',
+                        default=SNAPSHOT_FILE)
+    parser.add_argument("--max-age",
+                        dest='max_age',
+                        type=float,
+                        default=MAX_AGE)
+    parser.add_argument("--state-file",
+                        dest='state_file',
+                        default=STATE_FILE)
+    parser.add_argument("--format",
+                        dest='output_format',
+                        choices=['text', 'json', 'jsonl', 'csv'],
+                        default='text')
+    parser.add_argument("--interval",
+                        dest='interval',
+                        type=float,
+                        default=INTERVAL)
+    parser.add_argument("--http-port",
+                        dest='http_port',
+                        type=int)
+    parser.add_argument("--stats-file",
+                        dest='stats_file',
+                        default=None)
+    parser.add_argument("--prometheus-file",
+                        dest='prometheus_file',
+                        default=None)
 
     # Make all arguments globally accessible
     globals().update(vars(parser.parse_args()))
 
+    # Every -r can name several files.
+    global rm_files
+    rm_files = list(itertools.chain.from_iterable(rm_files
+                                                  or [[RADMIND_CONFIG]]))
+
     # If the user specified the explicit option, show all of the variables used.
     if explicit:
         print
@@ -482,15 +1233,50 @@ def parse_options ():
         print "  {:20} : {}".format('explicit', explicit)
         print "  {:20} : {}".format('dns_full', dns_full)
         print "  {:20} : {}".format('email', email)
-
-        print "  {:20} : {}".format('rm_file', rm_file)
+        print "  {:20} : {}".format('list_exclusions', list_exclusions)
+        print "  {:20} : {}".format('since_last', since_last)
+        print "  {:20} : {}".format('daemon', daemon)
+        print "  {:20} : {}".format('no_dns_cache', no_dns_cache)
+        print "  {:20} : {}".format('refresh_dns_cache', refresh_dns_cache)
+        print "  {:20} : {}".format('purge_dns_cache', purge_dns_cache)
+        print "  {:20} : {}".format('verify_dns', verify_dns)
+        print "  {:20} : {}".format('no_snapshot', no_snapshot)
+        print "  {:20} : {}".format('profile', profile)
+
+        print "  {:20} : {}".format('rm_files', ', '.join(rm_files))
         print "  {:20} : {}".format('im_file', im_file)
         print "  {:20} : {}".format('im_address', im_address)
         print "  {:20} : {}".format('out_file', out_file)
         print "  {:20} : {}".format('smtp_server', smtp_server)
         print "  {:20} : {}".format('destination_email', destination_email)
         print "  {:20} : {}".format('source_email', source_email)
+        print "  {:20} : {}".format('smtp_starttls', smtp_starttls)
+        print "  {:20} : {}".format('smtp_user', smtp_user)
+        print "  {:20} : {}".format('smtp_password_file', smtp_password_file)
+        print "  {:20} : {}".format('email_retries', email_retries)
+        print "  {:20} : {}".format('routes_file', routes_file)
+        print "  {:20} : {}".format('exclusions_file', exclusions_file)
         print "  {:20} : {}".format('log_dest', log_dest)
+        print "  {:20} : {}".format('dns_workers', dns_workers)
+        print "  {:20} : {}".format('radmind_parser', radmind_parser)
+        print "  {:20} : {}".format('resolver', resolver)
+        print "  {:20} : {}".format('nameservers', nameservers)
+        print "  {:20} : {}".format('dns_in_flight', dns_in_flight)
+        print "  {:20} : {}".format('dns_rate', dns_rate)
+        print "  {:20} : {}".format('dns_timeout', dns_timeout)
+        print "  {:20} : {}".format('dns_deadline', dns_deadline)
+        print "  {:20} : {}".format('dns_cache_file', dns_cache_file)
+        print "  {:20} : {}".format('dns_ttl', dns_ttl)
+        print "  {:20} : {}".format('dns_negative_ttl', dns_negative_ttl)
+        print "  {:20} : {}".format('dns_cache_size', dns_cache_size)
+        print "  {:20} : {}".format('snapshot_file', snapshot_file)
+        print "  {:20} : {}".format('max_age', max_age)
+        print "  {:20} : {}".format('state_file', state_file)
+        print "  {:20} : {}".format('output_format', output_format)
+        print "  {:20} : {}".format('interval', interval)
+        print "  {:20} : {}".format('http_port', http_port)
+        print "  {:20} : {}".format('stats_file', stats_file)
+        print "  {:20} : {}".format('prometheus_file', prometheus_file)
         print '-' * 80
         print
 
@@ -530,6 +1316,7 @@ def build_loggers ():
 
     # Create the root logger.  These are the settings for console output.
     logging.basicConfig(level=console_logging_level, format='%(message)s')
+    console_handlers = logging.getLogger().handlers
     global logger
     logger = logging.getLogger(__name__)
 
@@ -537,6 +1324,15 @@ def build_loggers ():
     # the logs out to a file.  If yes, write to the file and output simplified
     # information to the console.
     if os.access(log_dest, os.W_OK):
+        # The log file gets everything at its own level, however quiet the
+        # console is (-q is for cron, which still wants the log), so the root
+        # logger lets through whatever either one wants and the console's
+        # handler drops the rest.
+        for handler in console_handlers:
+            handler.setLevel(console_logging_level)
+        logging.getLogger().setLevel(min(console_logging_level,
+                                         file_logging_level))
+
         # Prepends with a line and the date.  Useful for searching through the
         # log file.
         nfh = logging.FileHandler(log_dest + LOG_FILE, mode='a')
@@ -555,118 +1351,1853 @@ def build_loggers ():
         fh.setLevel(file_logging_level)
         logger.addHandler(fh)
     else:
-        print "Logging will not be outputted to a file.  Check your variables."
+        print >>console_stream(), ("Logging will not be outputted to a file.  "
+                                   "Check your variables.")
 
 '''
 ################################################################################
 GET HOSTNAME
 
-    Takes an IP address and attempts to find a valid hostname for that address.
-    If none is found, False is stored in its place.
+    lookup_host() asks the system resolver for the hostname of one IP address.
+    If none is found, it gives back False.  If the lookup itself failed (the
+    nameserver timed out or gave an error rather than an answer), it gives back
+    None instead, so that an overloaded nameserver doesn't look like a missing
+    DNS entry.  short_host() turns the answer into what the report shows.
+
+    These only do the asking; the cache, the threads and the rate limit are
+    all handled by lookup_all() (see RESOLVE HOSTNAMES), which doesn't cache
+    failed lookups.
 ################################################################################
 '''
-def get_host (ip):
-    try:
-        data = socket.gethostbyaddr(ip)
-        host = repr(data[0])
-        if dns_full:
-            hostname = host
-        else:
-            hostname = host.split('.')[0]
-        logging.debug(ip + " => " + hostname)
-        return hostname
-    except Exception:
+# Turns a full hostname (or False, or None) into what the report shows.
+def short_host (ip, name):
+    if name is None:
+        logging.debug(ip + " => (lookup failed)")
+        return None
+    if not name:
         logging.debug(ip + " => ")
         return False
+    if dns_full:
+        hostname = name
+    else:
+        hostname = name.split('.')[0]
+    logging.debug(ip + " => " + hostname)
+    return hostname
+
+def lookup_host (ip):
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except Exception as e:
+        return lookup_error(e, 'dns_no_entry')
+
+# Looks up the addresses a hostname points to (for --verify-dns), as a
+# space-separated string.
+def lookup_addresses (name):
+    try:
+        return ' '.join(socket.gethostbyname_ex(name)[2]) or False
+    except Exception as e:
+        return lookup_error(e, 'verify_no_entry')
+
+# Sorts out why a system lookup failed.  If the nameserver answered that there
+# is no such record, that's counted under 'missing' and False is returned;
+# if it didn't give an answer at all, None is.
+def lookup_error (e, missing):
+    if isinstance(e, socket.herror):
+        # HOST_NOT_FOUND and NO_DATA are real answers; TRY_AGAIN and
+        # NO_RECOVERY mean the nameserver didn't give one.
+        answered = e.args and e.args[0] in (1, 4)
+    elif isinstance(e, socket.gaierror):
+        answered = e.args and e.args[0] in (socket.EAI_NONAME,
+                                             getattr(socket, 'EAI_NODATA',
+                                                     socket.EAI_NONAME))
+    else:
+        answered = False
+    if answered:
+        count(missing)
+        return False
+    count('dns_errors')
+    return None
+
+'''
+################################################################################
+SAVED FILES
+
+    The files kept between runs are all replaced the same way: written out in
+    full to a temporary file in the same directory, then renamed over the old
+    one, so an interrupted run never leaves half a file behind.  The program
+    usually runs as root, so the temporary file is made by tempfile.mkstemp()
+    (an unguessable name, only created if nothing is there already, and only
+    readable by us) rather than opened by a fixed name that someone else could
+    have left a symlink at.  'public' files are made readable by everyone.
+
+    trusted_file() is checked before one is read back: a file owned by someone
+    else, or that someone else can write to, could have been planted, so it's
+    ignored.  (The defaults are kept in /var/db, which only root can write.)
+################################################################################
+'''
+@contextlib.contextmanager
+def replace_file (path, mode='w', public=False):
+    f, temp = open_temp_file(path, mode, public)
+    try:
+        with f:
+            yield f
+        os.rename(temp, path)
+    except:
+        discard_file(temp)
+        raise
+
+# Opens a new temporary file to replace 'path' with; returns the file and its
+# name.
+def open_temp_file (path, mode='w', public=False):
+    directory, name = os.path.split(path)
+    fd, temp = tempfile.mkstemp(prefix=name + '.', suffix='.tmp',
+                                dir=directory or '.')
+    if public:
+        os.fchmod(fd, 0644)
+    return (os.fdopen(fd, mode), temp)
+
+def discard_file (temp):
+    if not temp:
+        return
+    try:
+        os.remove(temp)
+    except OSError:
+        pass
+
+def trusted_file (path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    if (info.st_uid not in (0, os.getuid())
+            or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        logger.warning("Ignoring [" + path + "]: it is owned or writable by "
+                       "another user.")
+        return False
+    return True
+
+'''
+################################################################################
+DNS CACHE
+
+    PTR records hardly ever change from one run to the next, so the full
+    hostname for each address is kept in a small JSON file (dns_cache_file)
+    between runs.  Because the full name is stored, the same entry serves both
+    the --dns-full and the shortened output.
+
+    Entries are good for dns_ttl seconds, or dns_negative_ttl seconds if the
+    address had no hostname.  The file holds at most dns_cache_size entries;
+    when it grows past that, the least recently used ones are dropped.
+
+    --no-dns-cache ignores the file completely, --refresh-dns-cache looks every
+    address up again but still saves the results, and --purge-dns-cache throws
+    the file away before starting.
+################################################################################
+'''
+def load_dns_cache ():
+    global DNS_CACHE
+    global DNS_CACHE_LOCK
+    global DNS_CACHE_HITS
+    global DNS_CACHE_MISSES
+
+    DNS_CACHE = collections.OrderedDict()
+    DNS_CACHE_LOCK = threading.Lock()
+    DNS_CACHE_HITS = 0
+    DNS_CACHE_MISSES = 0
+
+    if no_dns_cache:
+        return
+    if purge_dns_cache and os.path.exists(dns_cache_file):
+        try:
+            os.remove(dns_cache_file)
+            logger.info("Purged DNS cache [" + dns_cache_file + "].")
+        except OSError as e:
+            logger.warning("Could not purge DNS cache [" + dns_cache_file
+                           + "]: " + e.strerror)
+        return
+    if not os.path.exists(dns_cache_file) or not trusted_file(dns_cache_file):
+        return
+
+    try:
+        with open(dns_cache_file) as f:
+            entries = json.load(f)
+        # Entries are saved oldest-used first, so reading them back in order
+        # restores the LRU ordering.
+        for ip, name, stamp in entries:
+            DNS_CACHE[ip] = (name or False, stamp)
+    except (IOError, ValueError, TypeError) as e:
+        logger.warning("Could not read DNS cache [" + dns_cache_file
+                       + "]; starting with an empty cache.")
+        logger.debug(str(e))
+        DNS_CACHE.clear()
+        return
+    logger.debug("Loaded " + str(len(DNS_CACHE)) + " entries from DNS cache ["
+                 + dns_cache_file + "].")
+
+def save_dns_cache ():
+    if no_dns_cache:
+        return
+    with DNS_CACHE_LOCK:
+        while len(DNS_CACHE) > dns_cache_size:
+            DNS_CACHE.popitem(last=False)
+        entries = [[ip, DNS_CACHE[ip][0] or None, DNS_CACHE[ip][1]]
+                   for ip in DNS_CACHE]
+
+    # Written to a temporary file first (see SAVED FILES), so an interrupted
+    # run can't leave a half-written cache behind.
+    try:
+        with replace_file(dns_cache_file) as f:
+            json.dump(entries, f)
+    except (IOError, OSError) as e:
+        logger.warning("Could not write DNS cache [" + dns_cache_file + "]: "
+                       + str(e.strerror))
+        return
+    logger.info("DNS cache: " + str(DNS_CACHE_HITS) + " hits, "
+                + str(DNS_CACHE_MISSES) + " misses, " + str(len(entries))
+                + " entries saved.")
+
+def dns_cache_get (ip):
+    global DNS_CACHE_HITS
+    global DNS_CACHE_MISSES
+
+    if no_dns_cache or refresh_dns_cache:
+        return (False, None)
+    with DNS_CACHE_LOCK:
+        entry = DNS_CACHE.pop(ip, None)
+        if entry:
+            name, stamp = entry
+            if name:
+                ttl = dns_ttl
+            else:
+                ttl = dns_negative_ttl
+            if time.time() - stamp < ttl:
+                # Put it back at the most recently used end.
+                DNS_CACHE[ip] = entry
+                DNS_CACHE_HITS += 1
+                count('dns_cache_hits')
+                return (True, name)
+        DNS_CACHE_MISSES += 1
+        count('dns_cache_misses')
+        return (False, None)
+
+def dns_cache_put (ip, name):
+    if no_dns_cache:
+        return
+    with DNS_CACHE_LOCK:
+        DNS_CACHE.pop(ip, None)
+        DNS_CACHE[ip] = (name, time.time())
+
+'''
+################################################################################
+RESOLVE HOSTNAMES
+
+    Looks up the hostnames for a list of IP addresses.  The addresses are
+    integers (see IP ADDRESSES below), and so are the keys of the returned
+    {IP_Address: hostname} dictionary.  In it, "False" means the address has no
+    hostname and "None" means the lookup failed.  find_hostnames() gives the
+    full hostnames instead (False or None when there isn't one), before
+    display_hosts() shortens them.
+
+    lookup_all() does the work for any kind of Lookup: the reverse (PTR)
+    lookups here, and the forward (A) lookups of --verify-dns (see VERIFY
+    HOSTNAMES).  Each Lookup says which stage its metrics are named after, its
+    DNS query type and question, the key its answers are cached under (also
+    used in log messages), and the function that asks the system resolver.
+    Whatever is in the hostname cache is answered straight away; the rest is
+    looked up with the async resolver (see ASYNC DNS CLIENT) or, by default,
+    with a bounded pool of worker threads (at most dns_workers at once), so
+    that a single slow lookup doesn't hold up everything behind it.  How many
+    are looked up at once, and how quickly, is up to a DnsLimiter (see DNS RATE
+    LIMITING).
+
+    A lookup that takes longer than dns_timeout seconds is recorded as failed
+    (None), and a fresh worker takes over its place in the pool (there is no
+    way to cancel gethostbyaddr(), so the stuck thread is simply abandoned).
+    Once dns_deadline seconds have passed, everything still outstanding is
+    recorded as failed.  Failed lookups aren't cached.
+################################################################################
+'''
+Lookup = collections.namedtuple('Lookup', ['stage', 'qtype', 'qname', 'key',
+                                           'system'])
+
+def resolve_hosts (addresses):
+    return display_hosts(find_hostnames(addresses))
+
+def find_hostnames (addresses):
+    unique = set(addresses)
+    set_metric('dns_lookups', len(unique))
+    return lookup_all(unique, REVERSE_LOOKUP, "hostnames")
+
+def display_hosts (names):
+    hostnames = {}
+    for address in names:
+        ip = int_to_ip(address)
+        hostnames[address] = str(short_host(ip, names[address])).replace("'",
+                                                                         "")
+    return hostnames
+
+def lookup_all (keys, kind, name):
+    answers = {}
+    lookups = []
+    for key in keys:
+        hit, answer = dns_cache_get(kind.key(key))
+        if hit:
+            answers[key] = answer
+        else:
+            lookups.append(key)
+
+    progress = start_progress(len(answers) + len(lookups), name)
+    progress.update(len(answers))
+    servers = None
+    if lookups and resolver == 'async':
+        servers = dns_servers()
+        if not servers:
+            logger.warning("No nameservers found for the async resolver; "
+                           + "using the system resolver instead.")
+    if not lookups:
+        found = {}
+    elif servers:
+        found = lookup_async(lookups, kind, servers, progress, len(answers))
+    else:
+        found = lookup_threaded(lookups, kind, progress, len(answers))
+    progress.finish()
+
+    missed = 0
+    for key in lookups:
+        if key not in found:
+            missed += 1
+        answer = found.get(key)
+        if answer is not None:
+            dns_cache_put(kind.key(key), answer)
+        answers[key] = answer
+    set_metric(kind.stage + '_deadline_missed', missed)
+    if missed:
+        logger.warning("Lookups passed the deadline; " + str(missed)
+                       + " " + name + " were left unresolved.")
+    return answers
+
+def lookup_threaded (keys, kind, progress, done):
+    results = {}
+    pending = Queue.Queue()
+    for key in keys:
+        pending.put(key)
+    finished = Queue.Queue()
+    started = {}
+    abandoned = set()
+    lock = threading.Lock()
+    stop = threading.Event()
+    limiter = DnsLimiter(dns_workers)
+
+    def worker ():
+        while not stop.is_set():
+            try:
+                key = pending.get_nowait()
+            except Queue.Empty:
+                return
+            if not limiter.acquire(stop):
+                return
+            with lock:
+                started[key] = time.time()
+            answer = kind.system(kind.key(key))
+            with lock:
+                # Someone else has already taken this thread's place (and its
+                # place in the limiter).
+                if key in abandoned:
+                    return
+                started.pop(key, None)
+            limiter.release(answer is not None)
+            finished.put((key, answer))
+
+    def start_worker ():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for i in range(0, min(dns_workers, len(keys))):
+        start_worker()
+
+    deadline = time.time() + dns_deadline
+    while len(results) < len(keys):
+        progress.update(done + len(results))
+        now = time.time()
+        if now >= deadline:
+            break
+
+        # Wake up in time for whichever lookup will time out first.
+        wait = deadline - now
+        with lock:
+            for key in started:
+                wait = min(wait, started[key] + dns_timeout - now)
+        try:
+            key, answer = finished.get(timeout=max(wait, 0.01))
+            if key not in results:
+                results[key] = answer
+        except Queue.Empty:
+            pass
+
+        now = time.time()
+        with lock:
+            expired = [key for key in started
+                       if started[key] + dns_timeout <= now]
+            for key in expired:
+                del started[key]
+                abandoned.add(key)
+        for key in expired:
+            logger.debug("Lookup for " + kind.key(key) + " timed out.")
+            count('dns_timeouts')
+            limiter.release(False)
+            results[key] = None
+            start_worker()
+
+    stop.set()
+    set_metric(kind.stage + '_window', round(limiter.window, 1))
+    return results
+
+'''
+################################################################################
+VERIFY HOSTNAMES
+
+    A PTR record can outlive the computer it was made for: the address is
+    handed out again, or the computer is renamed, and the old hostname no
+    longer points back at the address.  With --verify-dns, the hostname found
+    for each address is looked up the other way (its A records), and any
+    address that isn't among them is reported as a stale PTR record.
+
+    Each hostname is only looked up once, however many addresses point at it,
+    using the same cache, resolver and rate limiting as the hostnames
+    themselves (see RESOLVE HOSTNAMES).  Hostnames whose lookup failed aren't
+    reported either way, so an overloaded nameserver can't make records look
+    stale.
+
+    Returns {IP_Address: addresses} for the stale records, where 'addresses'
+    are the hostname's addresses (space-separated), or "False" if it has none.
+################################################################################
+'''
+def verify_hosts (names):
+    unique = set(name for name in names.values() if name)
+    set_metric('verify_lookups', len(unique))
+    forward = lookup_all(unique, FORWARD_LOOKUP, "verifying")
+
+    stale = {}
+    for address, name in names.items():
+        if not name or forward.get(name) is None:
+            continue
+        if not forward[name] or int_to_ip(address) not in forward[name].split():
+            stale[address] = str(forward[name])
+    set_metric('verify_stale', len(stale))
+    return stale
+
+# What the text report shows after a stale PTR record's hostname.
+def stale_note (addresses):
+    if addresses == "False":
+        return "(stale PTR: no address)"
+    return "(stale PTR: points to " + addresses.replace(' ', ', ') + ")"
+
+'''
+################################################################################
+DNS RATE LIMITING
+
+    Looking up every address on campus as fast as possible can overload the
+    nameservers, and an overloaded nameserver times out or answers SERVFAIL.
+    A DnsLimiter holds the lookups back in two ways:
+
+    - A token bucket: with --dns-rate, at most dns_rate lookups are started a
+      second (with bursts of up to a second's worth).
+
+    - A window on how many lookups can be going at once, adjusted the way TCP
+      adjusts its congestion window (AIMD).  It starts at DNS_START_WINDOW and
+      grows by one for every answer until the first failure; after that, it
+      grows by about one for every window's worth of answers.  Whenever a lookup
+      times out or fails, the window is halved (at most once per lookup
+      interval, so a burst of failures only counts once).  It never goes above
+      'limit' (dns_workers or dns_in_flight) or below one.
+
+    Together these keep the lookups going about as fast as the nameservers can
+    take them.  Lookups that still fail are recorded as failed rather than as
+    missing (see GET HOSTNAME).
+
+    The system resolver's worker threads call acquire() and release(); the
+    async resolver, which is a single thread, checks window and take_token()
+    itself and reports back with feedback().
+################################################################################
+'''
+class DnsLimiter (object):
+    def __init__ (self, limit):
+        self.limit = max(1, limit)
+        self.window = float(min(self.limit, DNS_START_WINDOW))
+        self.threshold = float(self.limit)
+        self.rate = dns_rate
+        self.tokens = float(max(dns_rate, 1))
+        self.stamp = time.time()
+        self.in_use = 0
+        self.backed_off = 0
+        self.cooldown = dns_timeout / float(DNS_ATTEMPTS)
+        self.condition = threading.Condition()
+
+    # Takes a token if there is one (or regardless, if 'force' is given, which
+    # can leave the bucket owing tokens).
+    def take_token (self, force=False):
+        with self.condition:
+            if not self.rate:
+                return True
+            now = time.time()
+            self.tokens = min(max(self.rate, 1),
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1 or force:
+                self.tokens -= 1
+                return True
+            return False
+
+    # Seconds until the next token is due.
+    def token_wait (self):
+        if not self.rate or self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # Waits for both room in the window and a token.  Gives up (returning False)
+    # if 'stop' is set while waiting.
+    def acquire (self, stop):
+        with self.condition:
+            while not stop.is_set():
+                if self.in_use < int(self.window) and self.take_token():
+                    self.in_use += 1
+                    return True
+                self.condition.wait(min(0.1, max(0.001, self.token_wait())))
+            return False
+
+    def release (self, succeeded):
+        with self.condition:
+            self.in_use -= 1
+            self.feedback(succeeded)
+            self.condition.notify_all()
+
+    def feedback (self, succeeded):
+        with self.condition:
+            if succeeded:
+                if self.window < self.threshold:
+                    self.window += 1
+                else:
+                    self.window += 1 / self.window
+                self.window = min(self.window, float(self.limit))
+                return
+            now = time.time()
+            if now - self.backed_off < self.cooldown:
+                return
+            self.backed_off = now
+            self.threshold = max(1.0, self.window / 2)
+            self.window = self.threshold
+            count('dns_backoffs')
+            logger.debug("Hostname lookups backing off to "
+                         + str(int(self.window)) + " at once.")
+
+'''
+################################################################################
+ASYNC DNS CLIENT
+
+    gethostbyaddr() can't be given a timeout or cancelled, and each call ties up
+    a thread until it's done.  With --resolver async, hostnames are looked up
+    by sending PTR queries (for d.c.b.a.in-addr.arpa) straight to the
+    nameservers over UDP instead, from a single thread: up to dns_in_flight
+    queries are kept going at once, and select() hands back the answers as
+    they arrive.  The A queries of --verify-dns are sent the same way.
+
+    The nameservers come from --nameservers (comma-separated, each optionally
+    with a :port) or else the 'nameserver' lines of RESOLV_CONF.  Only IPv4
+    nameservers are used.
+
+    A query that hasn't been answered after dns_timeout / DNS_ATTEMPTS seconds
+    is sent again (to the next nameserver), up to DNS_ATTEMPTS times in all; a
+    SERVFAIL or REFUSED answer moves on to the next try straight away.  If an
+    answer comes back truncated, the query is asked again over TCP in a
+    BackgroundTask.  NXDOMAIN (or an answer without a PTR record) means the
+    address has no hostname (or, for an A query, that the hostname has no
+    address).  Anything still unanswered after all of its tries, or at
+    dns_deadline, is recorded as failed (None, and not cached).
+
+    New queries are only sent when the DnsLimiter allows (see DNS RATE
+    LIMITING); every timeout and SERVFAIL counts against it, and every answer
+    for it.
+
+    The hostname cache and the shortening of names work exactly as they do for
+    the system resolver (see RESOLVE HOSTNAMES).
+
+    Packets are built and read as bytearrays with struct, byte by byte, so
+    nothing depends on the str/bytes differences between Python versions.
+################################################################################
+'''
+def lookup_async (keys, kind, servers, progress, done):
+    results = {}
+    limiter = DnsLimiter(dns_in_flight)
+    client = DnsClient(servers, limiter, kind)
+    for key, answer in client.resolve(keys):
+        results[key] = answer
+        progress.update(done + len(results))
+    set_metric(kind.stage + '_window', round(limiter.window, 1))
+    return results
+
+def dns_servers ():
+    if nameservers:
+        entries = nameservers.split(',')
+    else:
+        entries = []
+        try:
+            with open(RESOLV_CONF) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) > 1 and fields[0] == 'nameserver':
+                        entries.append(fields[1])
+        except IOError as e:
+            logger.warning("Could not read [" + RESOLV_CONF + "]: "
+                           + e.strerror)
+
+    servers = []
+    for entry in entries:
+        host, colon, port = entry.strip().partition(':')
+        if not IP_PATTERN.match(host) or (colon and not port.isdigit()):
+            logger.debug("Skipping nameserver " + entry)
+            continue
+        servers.append((host, int(port or 53)))
+    return servers
+
+class DnsQuery (object):
+    __slots__ = ['key', 'ident', 'qname', 'packet', 'attempts', 'due']
+
+    def __init__ (self, key, ident, qname, qtype):
+        self.key = key
+        self.ident = ident
+        self.qname = qname
+        self.packet = query_packet(ident, qname, qtype)
+        self.attempts = 0
+        self.due = 0
+
+class DnsClient (object):
+    def __init__ (self, servers, limiter, kind):
+        self.servers = servers
+        self.limiter = limiter
+        self.kind = kind
+        self.random = random.SystemRandom()
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setblocking(0)
+        self.pending = {}
+        self.timers = []
+        self.tcp = []
+        self.answers = collections.deque()
+        self.interval = dns_timeout / float(DNS_ATTEMPTS)
+
+    # Yields (key, answer) for each key as it's answered (or given up on).  The
+    # answer is False if there is no such record, or None if the lookup never
+    # got a real answer.
+    def resolve (self, keys):
+        waiting = collections.deque(keys)
+        deadline = time.time() + dns_deadline
+        try:
+            while waiting or self.pending or self.tcp:
+                now = time.time()
+                if now >= deadline:
+                    break
+                while waiting and len(self.pending) + len(self.tcp) \
+                        < int(self.limiter.window) \
+                        and self.limiter.take_token():
+                    key = waiting.popleft()
+                    self.send(DnsQuery(key, self.new_ident(),
+                                       self.kind.qname(key), self.kind.qtype))
+
+                wait = deadline - now
+                if waiting:
+                    wait = min(wait, max(self.limiter.token_wait(), 0.001))
+                if self.timers:
+                    wait = min(wait, self.timers[0][0] - now)
+                if self.tcp:
+                    wait = min(wait, 0.05)
+                readable = select.select([self.udp], [], [], max(wait, 0))[0]
+                if readable:
+                    self.receive()
+                self.expire(time.time())
+                self.collect_tcp()
+                while self.answers:
+                    yield self.answers.popleft()
+        finally:
+            self.udp.close()
+
+    def new_ident (self):
+        while True:
+            ident = self.random.randint(0, 0xFFFF)
+            if ident not in self.pending:
+                return ident
+
+    def send (self, query):
+        server = self.servers[query.attempts % len(self.servers)]
+        # Resends aren't held back, but they do use up the rate limit.
+        if query.attempts:
+            self.limiter.take_token(True)
+        query.attempts += 1
+        query.due = time.time() + self.interval
+        self.pending[query.ident] = query
+        heapq.heappush(self.timers, (query.due, query.ident))
+        try:
+            self.udp.sendto(bytes(query.packet), server)
+        except socket.error as e:
+            # Treated like a lost packet: it'll be sent again when it's due.
+            logger.debug("Could not send to " + server[0] + ": " + str(e))
+        if query.attempts > 1:
+            count('dns_retransmits')
+
+    def retry (self, query):
+        if query.attempts >= DNS_ATTEMPTS:
+            count('dns_timeouts')
+            logger.debug("Lookup for " + query.qname + " timed out.")
+            self.answers.append((query.key, None))
+        else:
+            self.send(query)
+
+    def receive (self):
+        while True:
+            try:
+                data, source = self.udp.recvfrom(65535)
+            except socket.error:
+                return
+            self.answer(data, source)
+
+    # Handles an answer from UDP or, with 'query', the TCP answer to it.
+    def answer (self, data, source, query=None):
+        over_tcp = query is not None
+        try:
+            ident, truncated, rcode, qname, records = \
+                read_answer(data, self.kind.qtype)
+        except (ValueError, IndexError, struct.error):
+            logger.debug("Ignoring a malformed DNS answer.")
+            if over_tcp:
+                self.retry(query)
+            return
+        if not over_tcp:
+            query = self.pending.get(ident)
+            if not query or source not in self.servers:
+                return
+        # Not an answer to the question we asked; ignore it.
+        if ident != query.ident or qname.lower() != query.qname:
+            if over_tcp:
+                self.retry(query)
+            return
+        self.pending.pop(ident, None)
+
+        if truncated and not over_tcp:
+            count('dns_tcp_fallbacks')
+            server = self.servers[(query.attempts - 1) % len(self.servers)]
+            self.tcp.append((query, server,
+                             BackgroundTask(tcp_query, server, query.packet)))
+        elif rcode == 0 or rcode == 3:
+            self.limiter.feedback(True)
+            if not records:
+                count(self.kind.stage + '_no_entry')
+            # An address only gets the first of its hostnames, but a hostname
+            # keeps all of its addresses.
+            if self.kind.qtype == 12:
+                records = records[:1]
+            self.answers.append((query.key, ' '.join(records) or False))
+        else:
+            count('dns_errors')
+            self.limiter.feedback(False)
+            self.retry(query)
+
+    def expire (self, now):
+        while self.timers and self.timers[0][0] <= now:
+            due, ident = heapq.heappop(self.timers)
+            query = self.pending.get(ident)
+            # Already answered, or sent again since this timer was set.
+            if not query or query.due != due:
+                continue
+            del self.pending[ident]
+            self.limiter.feedback(False)
+            self.retry(query)
+
+    def collect_tcp (self):
+        for entry in list(self.tcp):
+            query, server, task = entry
+            if task.thread.is_alive():
+                continue
+            self.tcp.remove(entry)
+            try:
+                data = task.result()
+            except (socket.error, struct.error) as e:
+                logger.debug("TCP lookup for " + query.qname + " failed: "
+                             + str(e))
+                self.limiter.feedback(False)
+                self.retry(query)
+                continue
+            self.answer(data, server, query)
+
+def ptr_qname (address):
+    return '.'.join(reversed(int_to_ip(address).split('.'))) + '.in-addr.arpa'
+
+def a_qname (name):
+    return name.lower()
+
+def query_packet (ident, qname, qtype):
+    # Header: ID, flags (recursion desired), 1 question, no other records.
+    packet = bytearray(struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0))
+    for label in qname.split('.'):
+        packet.append(len(label))
+        packet.extend(label.encode('ascii'))
+    packet.append(0)
+    # QTYPE (PTR or A), QCLASS IN
+    packet.extend(struct.pack('!HH', qtype, 1))
+    return packet
+
+# Returns (ID, truncated?, RCODE, question name, records), where 'records' are
+# the answer's PTR hostnames or A addresses (whichever 'qtype' asks for).
+def read_answer (data, qtype):
+    data = bytearray(data)
+    ident, flags, questions, answers = struct.unpack('!HHHH', bytes(data[:8]))
+    if not flags & 0x8000 or questions != 1:
+        raise ValueError("not an answer to one question")
+    qname, offset = read_dns_name(data, 12)
+    offset += 4
+    records = []
+    for i in range(0, answers):
+        name, offset = read_dns_name(data, offset)
+        rtype, rclass, ttl, length = struct.unpack('!HHIH',
+                                                   bytes(data[offset:offset + 10]))
+        offset += 10
+        if rtype == qtype == 12:
+            records.append(read_dns_name(data, offset)[0])
+        elif rtype == qtype == 1 and length == 4:
+            records.append('.'.join(str(octet)
+                                    for octet in data[offset:offset + 4]))
+        offset += length
+    return (ident, bool(flags & 0x0200), flags & 0x000F, qname, records)
+
+# Reads a (possibly compressed) name starting at 'offset', and returns it along
+# with the offset just past it.
+def read_dns_name (data, offset):
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise ValueError("compression loop")
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+        elif length:
+            labels.append(data[offset + 1:offset + 1 + length]
+                          .decode('ascii', 'ignore'))
+            offset += 1 + length
+        else:
+            offset += 1
+            break
+    if end is None:
+        end = offset
+    return ('.'.join(labels), end)
+
+def tcp_query (server, packet):
+    connection = socket.create_connection(server, dns_timeout)
+    try:
+        connection.sendall(struct.pack('!H', len(packet)) + bytes(packet))
+        length = struct.unpack('!H', receive_exactly(connection, 2))[0]
+        return receive_exactly(connection, length)
+    finally:
+        connection.close()
+
+def receive_exactly (connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise socket.error("connection closed")
+        data.extend(chunk)
+    return bytes(data)
+
+'''
+################################################################################
+IP ADDRESSES
+
+    Internally, every IPv4 address is kept as a single 32-bit integer (so
+    '10.0.1.2' is 167772418), and lists of addresses are kept in compact arrays
+    of those integers rather than lists of strings.  Integers sort in the same
+    order as the addresses they represent, so no special sort key is needed.
+    Addresses are parsed once when they are read in, and only turned back into
+    dotted strings when they are displayed or looked up.
+################################################################################
+'''
+def ip_to_int (ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def int_to_ip (address):
+    return socket.inet_ntoa(struct.pack('!I', address))
+
+def parse_addresses (items, source):
+    addresses = array.array(ADDRESS_TYPE)
+    for item in items:
+        try:
+            addresses.append(ip_to_int(item))
+            logging.debug(source + " matches += " + item)
+        except socket.error:
+            logger.debug(source + " skipped invalid address " + item)
+    return addresses
+
+'''
+################################################################################
+ADDRESS RANGES
+
+    Holds a set of addresses as sorted, non-overlapping [start, end] ranges of
+    integers, so that the a.b.c.<d-e> shorthand (and runs of neighbouring
+    addresses) never have to be written out one address at a time.  Ranges that
+    overlap or touch are merged as they're added.
+
+    An AddressRanges acts like a sorted list of its addresses: len() gives the
+    number of addresses, iterating over it lists them one at a time (only as
+    they're needed), and 'address in ranges' is a binary search.  'listed' is
+    how many addresses were handed in before duplicates were merged away.  Two
+    AddressRanges are equal if they hold the same addresses.
+################################################################################
+'''
+class AddressRanges (object):
+    def __init__ (self, ranges=()):
+        self.starts = array.array(ADDRESS_TYPE)
+        self.ends = array.array(ADDRESS_TYPE)
+        self.listed = 0
+        for start, end in sorted(ranges):
+            self.listed += end - start + 1
+            self.append(start, end)
+
+    @classmethod
+    def from_addresses (cls, addresses):
+        ranges = cls()
+        for address in sorted(addresses):
+            ranges.listed += 1
+            ranges.append(address, address)
+        return ranges
+
+    # Ranges have to be appended in order of their start addresses.
+    def append (self, start, end):
+        if self.ends and start <= self.ends[-1] + 1:
+            if end > self.ends[-1]:
+                self.ends[-1] = end
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def intervals (self):
+        return itertools.izip(self.starts, self.ends)
+
+    def __len__ (self):
+        total = 0
+        for start, end in self.intervals():
+            total += end - start + 1
+        return total
+
+    def __iter__ (self):
+        for start, end in self.intervals():
+            for address in xrange(start, end + 1):
+                yield address
+
+    def __contains__ (self, address):
+        i = bisect.bisect_right(self.starts, address) - 1
+        return i >= 0 and address <= self.ends[i]
+
+    def __eq__ (self, other):
+        return (isinstance(other, AddressRanges)
+                and self.starts == other.starts and self.ends == other.ends)
+
+    def __ne__ (self, other):
+        return not self == other
+
+'''
+################################################################################
+SUBNET ROUTES
+
+    Different teams look after different subnets.  With --routes, the report is
+    also split up by subnet and each team gets its own part, from the same run.
+    The routes file has one subnet per line:
+
+        # subnet         team        recipients (optional)
+        10.1.0.0/16      biology     bio-it@domain.com,lab@domain.com
+        10.2.4.0/24      library     lib-it@domain.com
+        10.2.4.128/25    library-av
+
+    A team can be listed against any number of subnets.  If subnets overlap,
+    the most specific one wins, so library-av above gets 10.2.4.128 to
+    10.2.4.255 and library gets the rest of 10.2.4.0/24.
+
+    The routes are loaded once into a RouteTable: sorted, non-overlapping
+    ranges, each belonging to one team.  Since the disparities are sorted too,
+    partition() splits them up in a single pass down both lists together.
+    Each team's part then goes to the usual places: a file next to the -o file
+    (output.txt becomes output.biology.txt), and an email to the team's
+    recipients when -e is given.  Addresses not in any subnet only show up in
+    the main report.
+################################################################################
+'''
+RouteTable = collections.namedtuple('RouteTable', ['starts', 'ends', 'teams',
+                                                   'recipients'])
+
+def load_routes ():
+    global ROUTES
+    if not routes_file:
+        return
+    legit_file(routes_file, "routes")
+
+    entries = []
+    recipients = collections.OrderedDict()
+    with open(routes_file) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                start, end = parse_subnet(fields[0])
+            except ValueError:
+                logger.warning("Skipping line " + str(number) + " of ["
+                               + routes_file + "]: bad subnet " + fields[0])
+                continue
+            if len(fields) > 1:
+                team = fields[1]
+            else:
+                team = fields[0]
+            recipients.setdefault(team, [])
+            if len(fields) > 2:
+                for address in fields[2].split(','):
+                    if address and address not in recipients[team]:
+                        recipients[team].append(address)
+            entries.append((start, end, team))
+
+    ROUTES = route_table(entries, recipients)
+    logger.info("Loaded " + str(len(entries)) + " subnets for "
+                + str(len(recipients)) + " teams from [" + routes_file + "].")
+
+def parse_subnet (text):
+    address, slash, bits = text.partition('/')
+    try:
+        base = ip_to_int(address)
+    except socket.error:
+        raise ValueError(text)
+    if slash:
+        bits = int(bits)
+    else:
+        bits = 32
+    if not 0 <= bits <= 32:
+        raise ValueError(text)
+    size = 1 << (32 - bits)
+    start = base & ~(size - 1) & 0xFFFFFFFF
+    return (start, start + size - 1)
+
+# Cuts the subnets up at every boundary and gives each piece to the smallest
+# subnet that covers it.  There are never more than a few hundred subnets, so
+# the simple way is plenty fast.
+def route_table (entries, recipients):
+    boundaries = set()
+    for start, end, team in entries:
+        boundaries.add(start)
+        boundaries.add(end + 1)
+    boundaries = sorted(boundaries)
+
+    table = RouteTable(array.array(ADDRESS_TYPE), array.array(ADDRESS_TYPE),
+                       [], recipients)
+    for low, high in itertools.izip(boundaries, boundaries[1:]):
+        owner = None
+        for start, end, team in entries:
+            if start <= low and high - 1 <= end:
+                if owner is None or end - start < owner[1] - owner[0]:
+                    owner = (start, end, team)
+        if owner is None:
+            continue
+        if table.teams and table.teams[-1] == owner[2] \
+                and table.ends[-1] + 1 == low:
+            table.ends[-1] = high - 1
+        else:
+            table.starts.append(low)
+            table.ends.append(high - 1)
+            table.teams.append(owner[2])
+    return table
+
+# Splits an AddressRanges into {team: AddressRanges} in one pass.
+def partition (ranges, table):
+    parts = dict((team, AddressRanges()) for team in table.recipients)
+    i = 0
+    total = len(table.starts)
+    for start, end in ranges.intervals():
+        while i < total and table.ends[i] < start:
+            i += 1
+        # A single range can run across more than one subnet.
+        j = i
+        while j < total and table.starts[j] <= end:
+            parts[table.teams[j]].append(max(start, table.starts[j]),
+                                         min(end, table.ends[j]))
+            j += 1
+    return parts
+
+# Writes each team's part of the report to its own file (with -o) and returns
+# the email messages for the teams that have recipients (with -e).
+def team_reports (sections, results):
+    split = [(title, side, partition(addresses, ROUTES))
+             for title, side, addresses in sections]
+    messages = []
+    for team in ROUTES.recipients:
+        team_sections = [(title, side, parts[team])
+                         for title, side, parts in split]
+        if not any(addresses.starts for title, side, addresses
+                   in team_sections):
+            logger.info("Nothing to report for " + team + ".")
+            continue
+
+        sinks = []
+        if out_file:
+            report_file = open_file_output(team_output_path(team))
+            sinks.append(report_file)
+        recipients = ROUTES.recipients[team]
+        if email and recipients:
+            body = StringIO.StringIO()
+            body.write(report_header())
+            sinks.append(body)
+        write_report (team_sections, results, sinks)
+
+        if out_file:
+            close_file_output (report_file)
+        if email and recipients:
+            short_date = datetime.datetime.now().strftime('%A, %B %d')
+            messages.append(email_message(
+                body.getvalue(), recipients,
+                "Radmind/Intermapper Differences for " + team + " "
+                + short_date))
+    return messages
+
+def team_output_path (team):
+    root, extension = os.path.splitext(out_file)
+    return root + "." + re.sub('[^A-Za-z0-9_.-]', '_', team) + extension
+
+'''
+################################################################################
+EXCLUSIONS
+
+    Some addresses never need to be reported: printers, DHCP pools, lab gear
+    that isn't managed by Radmind, and so on.  These go in the exclusions file
+    (exclusions_file), one per line, written like Radmind addresses or as
+    subnets, with anything after them ignored:
+
+        10.1.2.3            front desk printer
+        10.1.4.<100-199>    DHCP pool
+        10.8.0.0/16         lab network
+
+    They're compiled into a single AddressRanges (sorted, with overlaps
+    merged), and exclude() drops them from both lists in one pass right after
+    the lists are read, before the disparities are found or any hostnames are
+    looked up.  -E lists the compiled exclusions and quits.
+
+    If the default exclusions file doesn't exist, nothing is excluded; if a file
+    given with --exclusions doesn't exist, that's an error.
+################################################################################
+'''
+def load_exclusions ():
+    global EXCLUSIONS
+    path = exclusions_file or EXCLUSIONS_FILE
+    if not exclusions_file and not os.path.exists(path):
+        return
+    legit_file(path, "exclusions")
+
+    ranges = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                ranges.append(parse_range(fields[0]))
+            except ValueError:
+                logger.warning("Skipping line " + str(number) + " of [" + path
+                               + "]: bad address " + fields[0])
+    EXCLUSIONS = AddressRanges(ranges)
+    logger.info("Loaded " + str(len(ranges)) + " exclusions ("
+                + str(len(EXCLUSIONS)) + " addresses) from [" + path + "].")
+
+# Turns 'a.b.c.d', 'a.b.c.<d-e>' or 'a.b.c.d/n' into a (start, end) range.
+def parse_range (text):
+    if '/' in text:
+        return parse_subnet(text)
+    first = RM_FIRST.findall(text)
+    if first:
+        base = RM_3.match(text)
+        last = RM_LAST.findall(text)
+        if not base or not last:
+            raise ValueError(text)
+        try:
+            start = ip_to_int(base.group(0) + '0')
+        except socket.error:
+            raise ValueError(text)
+        first = int(first[0])
+        last = min(int(last[0]), 255)
+        if first > last:
+            raise ValueError(text)
+        return (start + first, start + last)
+    if not IP_PATTERN.match(text):
+        raise ValueError(text)
+    try:
+        address = ip_to_int(text)
+    except socket.error:
+        raise ValueError(text)
+    return (address, address)
+
+# Returns the addresses in 'ranges' that aren't in 'excluded', walking both
+# (sorted) lists once.
+def exclude (ranges, excluded):
+    if not excluded:
+        return ranges
+    kept = AddressRanges()
+    i = 0
+    total = len(excluded.starts)
+    for start, end in ranges.intervals():
+        while i < total and excluded.ends[i] < start:
+            i += 1
+        j = i
+        while start <= end:
+            if j < total and excluded.starts[j] <= end:
+                if excluded.starts[j] > start:
+                    kept.append(start, excluded.starts[j] - 1)
+                start = excluded.ends[j] + 1
+                j += 1
+            else:
+                kept.append(start, end)
+                break
+    kept.listed = ranges.listed - (len(ranges) - len(kept))
+    return kept
+
+def print_exclusions ():
+    if not EXCLUSIONS:
+        print "No exclusions."
+        return
+    for start, end in EXCLUSIONS.intervals():
+        if start == end:
+            print int_to_ip(start)
+        elif start >> 8 == end >> 8:
+            print "{0}<{1}-{2}>".format(int_to_ip(start)
+                                        [:-len(str(start & 255))],
+                                        start & 255, end & 255)
+        else:
+            print int_to_ip(start) + " - " + int_to_ip(end)
+    print
+    print "{0} addresses in {1} ranges.".format(len(EXCLUSIONS),
+                                                len(EXCLUSIONS.starts))
+
+'''
+################################################################################
+LOAD SOURCES
+
+    Reading the Radmind config is all local work, while getting the InterMapper
+    list is mostly waiting on the network, so the two are done at the same time:
+    the Radmind config is read in a background thread while the InterMapper
+    list is fetched here (it has to be this thread, since it may need to ask the
+    user for credentials).
+
+    While both are running their individual progress messages are held back
+    (see HELD CONSOLE), and a single combined "[done]" or "[failed]" is given
+    at the end, followed by whatever they logged along the way.  If either
+    one fails, both are reported and the program exits with the same code it
+    always has (10, 11 or 20), the Radmind failure taking precedence as it did
+    when Radmind was always read first.
+################################################################################
+'''
+def load_sources ():
+    prompt = "Getting Radmind and InterMapper lists..."
+    pretty_print (prompt)
+
+    hold_console()
+    try:
+        radmind = BackgroundTask(load_radmind)
+
+        # If the user specifies a file to get them from, use that.  Otherwise,
+        # attempt to connect to im_address and use a new version.
+        im_list = None
+        im_error = None
+        try:
+            if im_file:
+                im_list = load_source('intermapper', im_file,
+                                      get_intermapper_file)
+            else:
+                with timed('intermapper'):
+                    im_list = get_intermapper_web()
+        except SystemExit as e:
+            im_error = e
+
+        rm_list = None
+        rm_error = None
+        try:
+            rm_list = radmind.result()
+        except SystemExit as e:
+            rm_error = e
+    finally:
+        held = release_console()
+
+    # If the combined line was broken up to ask for credentials, start it again.
+    if held.interrupted:
+        pretty_print (prompt)
+    if rm_error or im_error:
+        pretty_print (prompt, 2)
+        held.flush()
+        if rm_error:
+            logger.error("Radmind list failed (exit code " + str(rm_error.code)
+                         + ").")
+        if im_error:
+            logger.error("InterMapper list failed (exit code "
+                         + str(im_error.code) + ").")
+        raise rm_error or im_error
+
+    pretty_print (prompt, 1)
+    held.flush()
+    return (rm_list, im_list)
+
+'''
+################################################################################
+PREVIOUS RUN STATE
+
+    With --since-last, everything needed to tell what has changed is kept in
+    state_file (JSON) between runs (and with --daemon, the same is kept in
+    memory):
+        - for each source file, its modification time, size and SHA-1 hash,
+          along with the addresses that were read from it
+        - the Radmind and InterMapper disparities
+        - the hostnames of the addresses in those disparities
+
+    If a source file's modification time and size are the same as last time
+    (or, failing that, its hash is), the addresses from last time are used and
+    the file isn't parsed at all.  Each Radmind config file (including the
+    ones pulled in with @include) is checked on its own, so changing one of
+    them only means reading that one again.  The InterMapper web page is
+    handled by its own snapshot (see INTERMAPPER SNAPSHOT) instead.
+
+    changes_since_last() compares this run's disparities against the saved ones
+    and returns the output sections for the new disparities, the disparities
+    that now have a hostname when they didn't before, and the disparities that
+    have gone away, along with the hostnames to report them with (this run's,
+    plus last run's for the ones that have gone away).
+################################################################################
+'''
+def load_state ():
+    global PREVIOUS_STATE
+    global SOURCE_FINGERPRINTS
+
+    PREVIOUS_STATE = {}
+    SOURCE_FINGERPRINTS = {}
+    if (not since_last or not os.path.exists(state_file)
+            or not trusted_file(state_file)):
+        return
+    try:
+        with open(state_file) as f:
+            PREVIOUS_STATE = json.load(f)
+    except (IOError, ValueError) as e:
+        logger.warning("Could not read state file [" + state_file
+                       + "]; reporting everything as new.")
+        logger.debug(str(e))
+        PREVIOUS_STATE = {}
+
+def build_state (im_sorted, rm_diff, im_diff, hostnames, files):
+    state = {'rm_diff': range_list(rm_diff),
+             'im_diff': range_list(im_diff),
+             'hostnames': {}}
+    for address in itertools.chain(rm_diff, im_diff):
+        state['hostnames'][str(address)] = hostnames.get(address, "False")
+    saved = {}
+    for radmind_file in files:
+        if radmind_file.fingerprint:
+            saved[radmind_file.path] = {
+                'fingerprint': radmind_file.fingerprint,
+                'ranges': range_list(radmind_file.ranges),
+                'listed': radmind_file.ranges.listed,
+                'includes': radmind_file.includes}
+    if saved:
+        state['radmind_files'] = saved
+    if 'intermapper' in SOURCE_FINGERPRINTS:
+        state['intermapper'] = {'fingerprint': SOURCE_FINGERPRINTS['intermapper'],
+                                'ranges': range_list(im_sorted)}
+    return state
+
+def save_state (state):
+    try:
+        with replace_file(state_file) as f:
+            json.dump(state, f)
+    except (IOError, OSError) as e:
+        logger.warning("Could not write state file [" + state_file + "]: "
+                       + str(e.strerror))
+        return
+    logger.info("Saved state to [" + state_file + "].")
+
+def range_list (ranges):
+    return [[start, end] for start, end in ranges.intervals()]
+
+def load_radmind ():
+    with timed('radmind'):
+        return get_radmind()
+
+# Runs loader() to get the addresses from 'path', unless the file is the same as
+# it was last run.  (The Radmind configs are checked one file at a time by
+# get_radmind() instead.)
+def load_source (name, path, loader):
+    with timed(name):
+        return load_changed_source(name, path, loader)
+
+def load_changed_source (name, path, loader):
+    if not since_last and not daemon:
+        return loader()
+
+    previous = PREVIOUS_STATE.get(name)
+    if previous:
+        fingerprint = file_fingerprint(path, previous['fingerprint'])
+    else:
+        fingerprint = file_fingerprint(path)
+    if fingerprint:
+        SOURCE_FINGERPRINTS[name] = fingerprint
+    if previous and fingerprint == previous['fingerprint']:
+        logger.info("[" + path + "] is unchanged since the last run.")
+        return AddressRanges(tuple(item) for item in previous['ranges'])
+    return loader()
+
+def file_fingerprint (path, previous=None):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    if (previous and previous['mtime'] == info.st_mtime
+            and previous['size'] == info.st_size):
+        return previous
+
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except IOError:
+        return None
+    fingerprint = {'mtime': info.st_mtime,
+                   'size': info.st_size,
+                   'sha1': digest.hexdigest()}
+    # Touched, but not actually changed.
+    if previous and previous['sha1'] == fingerprint['sha1']:
+        return previous
+    return fingerprint
+
+def changes_since_last (rm_diff, im_diff, hostnames):
+    names = hostnames
+    previous_names = {}
+    for address, hostname in PREVIOUS_STATE.get('hostnames', {}).items():
+        previous_names[int(address)] = hostname
+
+    sections = []
+    gone_sections = []
+    for title, side, key, current in [("Radmind items", 'radmind', 'rm_diff',
+                                       rm_diff),
+                                      ("InterMapper items", 'intermapper',
+                                       'im_diff', im_diff)]:
+        previous = AddressRanges(tuple(item)
+                                 for item in PREVIOUS_STATE.get(key, []))
+        new, gone, same = differences(current, previous)
+
+        resolved = AddressRanges()
+        for address in same:
+            if (previous_names.get(address, "False") == "False"
+                    and hostnames.get(address, "False") not in ("False",
+                                                                "None")):
+                resolved.append(address, address)
+
+        # Addresses that have gone from both lists were never looked up this
+        # time, so fall back on what they were called last time.  Those go in
+        # a copy, leaving this run's own hostnames as they are.
+        for address in gone:
+            if address not in names:
+                if names is hostnames:
+                    names = dict(hostnames)
+                names[address] = previous_names.get(address, "False")
+
+        sections.append(("New " + title, side, new))
+        sections.append(("Newly resolved " + title, side, resolved))
+        gone_sections.append(("Fixed " + title, side, gone))
+    logger.info("Found changes since the last run.")
+    return (sections + gone_sections, names)
+
+'''
+################################################################################
+BACKGROUND TASK
+
+    Runs function(*args) in its own thread.  result() waits for it to finish
+    and returns whatever it returned, or raises whatever it raised (including
+    the SystemExit from a sys.exit() call, so exit codes survive the trip).
+################################################################################
+'''
+class BackgroundTask (object):
+    def __init__ (self, function, *args):
+        self.function = function
+        self.args = args
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run (self):
+        try:
+            self.value = self.function(*self.args)
+        except BaseException:
+            self.error = sys.exc_info()
+
+    def result (self):
+        # Joining with a timeout keeps Ctrl-C working while we wait.
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+        if self.error:
+            raise self.error[1], None, self.error[2]
+        return self.value
 
 '''
 ################################################################################
 RADMIND FILE
 
-    Scans the Radmind config file (usually located at /var/radmind/config) and
-    records all of the IP addresses that appear at the beginnings of lines, and
-    then returns those as a list.
+    Scans the Radmind config files (usually just /var/radmind/config) and
+    records all of the IP addresses that appear at the beginnings of lines.
+    The a.b.c.<d-e> shorthand is kept as a single range rather than being
+    written out one address at a time.
+
+    -r can name any number of files, and each one can be a glob
+    ('/var/radmind/config.d/*').  A config can also pull in other files with
+    lines like:
+
+        @include labs/*.config
+
+    where the file (or glob) is relative to the config that includes it.  Every
+    file is read once, however many times it's named or included, with up to
+    RADMIND_WORKERS of them being read at the same time in background threads.
+    The addresses from all of them are merged into a single AddressRanges, with
+    any overlapping ranges merged together.
+
+    Each file is memory-mapped and searched with the single RM_LINE pattern,
+    which picks out the plainly written a.b.c.d and a.b.c.<d-e> entries (and
+    @include lines) and turns them straight into integers.  Anything else that
+    looks like the start of an address (leading zeros, a broken range, ...) is
+    left to the classic parser's rules, one entry at a time, so the results are
+    always the same as the classic parser's.  The classic parser, which reads
+    line by line and tries each of the RM_ patterns in turn, is still there
+    with --radmind-parser classic, and --radmind-parser verify runs both and
+    warns if they ever disagree.  Files that can't be memory-mapped (pipes,
+    special files) always get the classic parser.
+
+    A RadmindFile for each file is kept in RADMIND_FILES, in the order they
+    were found, and each run keeps that list with its Results, so the report
+    can say which config each address came from (see WRITE REPORT).  With
+    --since-last or --daemon, a file that hasn't changed since the last run
+    isn't read again (see PREVIOUS RUN STATE).
 ################################################################################
 '''
+RadmindFile = collections.namedtuple('RadmindFile', ['path', 'ranges',
+                                                     'includes', 'fingerprint'])
+
 ## RADMIND ADDRESSES
 def get_radmind ():
-    matches = []
-    prompt = "Getting Radmind list from [" + rm_file + "]..."
-
+    global RADMIND_FILES
+    prompt = "Getting Radmind list from [" + ', '.join(rm_files) + "]..."
     pretty_print (prompt)
-    legit_file (rm_file, "rm", prompt)
+
+    files = []
+    seen = set()
+    waiting = collections.deque(expand_paths(rm_files))
+    reading = collections.deque()
+    while waiting or reading:
+        while waiting and len(reading) < RADMIND_WORKERS:
+            path = waiting.popleft()
+            if os.path.realpath(path) in seen:
+                continue
+            seen.add(os.path.realpath(path))
+            reading.append(BackgroundTask(read_radmind_file, path, prompt))
+        if not reading:
+            continue
+        radmind_file = reading.popleft().result()
+        files.append(radmind_file)
+        waiting.extend(expand_paths(radmind_file.includes,
+                                    os.path.dirname(radmind_file.path)))
+
+    ranges = AddressRanges(itertools.chain.from_iterable(
+        radmind_file.ranges.intervals() for radmind_file in files))
+    ranges.listed = sum(radmind_file.ranges.listed for radmind_file in files)
+    RADMIND_FILES = files
+    set_metric('radmind_files', len(files))
+
+    pretty_print (prompt, 1)
+
+    logger.info("Got Radmind list from ["
+                + ', '.join(radmind_file.path for radmind_file in files)
+                + "].")
+    return ranges
+
+# Expands any globs among 'patterns' (relative to 'directory').  A pattern that
+# doesn't match anything is kept as it is, so that opening it gives the usual
+# error.
+def expand_paths (patterns, directory=''):
+    paths = []
+    for pattern in patterns:
+        pattern = os.path.join(directory, os.path.expanduser(pattern))
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+# Reads one config file, unless it's the same as it was last run.
+def read_radmind_file (path, prompt):
+    legit_file (path, "rm", prompt)
+    if not since_last and not daemon:
+        ranges, includes = parse_radmind(path)
+        return RadmindFile(path, ranges, includes, None)
+
+    previous = PREVIOUS_STATE.get('radmind_files', {}).get(path)
+    if previous:
+        fingerprint = file_fingerprint(path, previous['fingerprint'])
+    else:
+        fingerprint = file_fingerprint(path)
+    if previous and fingerprint == previous['fingerprint']:
+        logger.info("[" + path + "] is unchanged since the last run.")
+        ranges = AddressRanges(tuple(item) for item in previous['ranges'])
+        ranges.listed = previous['listed']
+        return RadmindFile(path, ranges, previous['includes'], fingerprint)
+    ranges, includes = parse_radmind(path)
+    return RadmindFile(path, ranges, includes, fingerprint)
+
+# Returns the AddressRanges listed in one config file, and the files it
+# includes (as written).
+def parse_radmind (path):
+    count('radmind_bytes', os.path.getsize(path))
+    if radmind_parser == 'classic':
+        return parse_radmind_classic(path)
+    ranges, includes = parse_radmind_fast(path)
+    if radmind_parser == 'verify':
+        classic, classic_includes = parse_radmind_classic(path)
+        if (classic != ranges or classic.listed != ranges.listed
+                or classic_includes != includes):
+            count('radmind_parser_mismatches')
+            logger.warning("The fast and classic parsers disagree about ["
+                           + path + "]; using the classic one.")
+            return (classic, classic_includes)
+    return (ranges, includes)
+
+def parse_radmind_fast (path):
+    with open(path, 'rb') as f:
+        info = os.fstat(f.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            return parse_radmind_classic(path)
+        # An empty file can't be mapped.
+        if not info.st_size:
+            return (AddressRanges(), [])
+        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    ranges = []
+    includes = []
+    # Most entries share their first three octets with the ones around them,
+    # so each 'a.b.c.' is only worked out once.  (None if it isn't valid.)
+    bases = {}
+    octets = dict((str(octet), octet) for octet in range(0, 256))
+    try:
+        for match in RM_LINE.finditer(text):
+            prefix, d, first, last, item, include = match.groups()
+            if include:
+                includes.append(include)
+                continue
+            if item:
+                radmind_item(item, ranges)
+                continue
+            if prefix not in bases:
+                a, b, c = [octets.get(octet) for octet in prefix.split('.')[:3]]
+                if None in (a, b, c):
+                    bases[prefix] = None
+                else:
+                    bases[prefix] = (a << 24) | (b << 16) | (c << 8)
+            base = bases[prefix]
+            if base is None:
+                continue
+            if d:
+                d = octets.get(d)
+                if d is not None:
+                    ranges.append((base + d, base + d))
+            else:
+                first = int(first)
+                last = min(int(last), 255)
+                if first <= last:
+                    ranges.append((base + first, base + last))
+    finally:
+        text.close()
+    logger.debug("Radmind matches += " + str(len(ranges)) + " entries from ["
+                 + path + "]")
+    return (AddressRanges(ranges), includes)
+
+def parse_radmind_classic (path):
+    ranges = []
+    includes = []
     addresses = []
-    with open(rm_file) as f:
+    with open(path) as f:
         for line in f:
             result = RM_PATTERN.match(line)
             if result:
                 addresses.append(result.group(0))
+            elif line.split()[:1] == [INCLUDE]:
+                includes.extend(line.split()[1:2])
 
     for item in addresses:
-        first = RM_FIRST.findall(item)
-        if first:
-            base = RM_3.findall(item)
-            last = RM_LAST.findall(item)
-            for x in range (int(first[0]), int(last[0]) + 1):
-                full = base[0] + str(x)
-                matches.append(full)
-                logging.debug("Radmind matches += " + full)
-        else:
-            if not re.search('-', item):
-                matches.append(item)
-                logging.debug("Radmind matches += " + item)
+        radmind_item(item, ranges)
+    return (AddressRanges(ranges), includes)
+
+# Adds the address (or a.b.c.<d-e> range) in one Radmind entry to 'ranges'.
+def radmind_item (item, ranges):
+    first = RM_FIRST.findall(item)
+    if first:
+        base = RM_3.findall(item)
+        last = RM_LAST.findall(item)
+        try:
+            start = ip_to_int(base[0] + '0')
+        except socket.error:
+            logger.debug("Radmind skipped invalid address " + item)
+            return
+        first = int(first[0])
+        last = min(int(last[0]), 255)
+        if first <= last:
+            ranges.append((start + first, start + last))
+            logging.debug("Radmind matches += " + item)
+    else:
+        if not re.search('-', item):
+            for address in parse_addresses([item], "Radmind"):
+                ranges.append((address, address))
 
-    pretty_print (prompt, 1)
+# Which of the Radmind config files read for 'results' list 'address'.
+def radmind_files (results, address):
+    return [radmind_file.path for radmind_file in results.radmind_files
+            if address in radmind_file.ranges]
 
-    logger.info("Got Radmind list from [" + rm_file + "].")
-    return matches
+'''
+################################################################################
+STREAMING ADDRESS PARSER
+
+    Reads a file-like object (an open file or a urllib2 response) chunk_size
+    bytes at a time and yields every IP address in it as soon as it's been
+    read, so that a large InterMapper page is never held in memory all at once.
+
+    An address can be cut in half at the end of a chunk.  No address can contain
+    anything but digits and dots, so the trailing run of digits and dots in
+    each chunk is held back and searched again along with the next chunk.  This
+    finds exactly the same addresses as searching the whole text at once.
+
+    Every address on both lists gets its hostname looked up, whatever the
+    disparity turns out to be (see RUN ONCE), so the lookups could start on
+    these addresses while the page is still downloading.  They don't: the
+    lookups are done once, for the Radmind and InterMapper addresses together
+    (each address only once, however many times it's listed), under a single
+    deadline and DnsLimiter (see RESOLVE HOSTNAMES), and that needs the whole
+    set of addresses first.  The overlap would only help on a full download
+    with a cold hostname cache anyway; with a snapshot, a 304 or --max-age
+    nothing is streamed, and cached hostnames take no time to look up.
+################################################################################
+'''
+def stream_addresses (stream):
+    tail = ''
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        count('intermapper_bytes', len(chunk))
+        text = tail + chunk
+        cut = len(text)
+        while cut > 0 and text[cut - 1] in ADDRESS_CHARACTERS:
+            cut -= 1
+        for match in IP_PATTERN.finditer(text, 0, cut):
+            yield match.group(0)
+        tail = text[cut:]
+    for match in IP_PATTERN.finditer(tail):
+        yield match.group(0)
 
 '''
 ################################################################################
 INTERMAPPER FILE
 
     In the event that a file is specified which contains all of the IP addresses
-    for InterMapper, this will try to record them all.
+    for InterMapper, this will try to record them all.  They're returned sorted,
+    without duplicates, as an AddressRanges.
 ################################################################################
 '''
 def get_intermapper_file ():
-    matches = []
     prompt = "Getting InterMapper list from [" + im_file + "]..."
 
     pretty_print (prompt)
 
     legit_file (im_file, "im", prompt)
     with open(im_file) as f:
-        matches = IP_PATTERN.findall(f.read())
-        for item in matches:
-            logging.debug("InterMapper matches += " + item)
+        matches = parse_addresses(stream_addresses(f), "InterMapper")
         pretty_print (prompt, 1)
 
     logger.info("Got InterMapper list from [" + im_file + "].")
-    return matches
+    return AddressRanges.from_addresses(matches)
 
 '''
 ################################################################################
 INTERMAPPER WEB
 
     InterMapper has a webpage with all of the IP addresses for its monitored
-    devices.  Try to access that page and return a list containing all of those
-    IP addresses
+    devices.  Try to access that page and return an AddressRanges containing all
+    of those IP addresses.  The page is parsed as it downloads, rather than
+    being read into memory all at once.
 ################################################################################
 '''
 def get_intermapper_web ():
     prompt = "Getting InterMapper list from [" + im_address + "]..."
-    matches = []
+
+    # If the last download is recent enough, don't bother asking again.
+    snapshot = load_snapshot()
+    if snapshot and max_age > 0:
+        age = time.time() - snapshot['fetched']
+        if age < max_age:
+            logger.info("Using InterMapper snapshot [" + snapshot_file + "] ("
+                        + str(int(age)) + " seconds old).")
+            return AddressRanges.from_addresses(snapshot['addresses'])
 
     pretty_print (prompt)
     while True:
         try:
-            page = urllib2.urlopen(im_address).read()
+            request = urllib2.Request(im_address)
+            if snapshot:
+                if snapshot.get('etag'):
+                    request.add_header('If-None-Match', snapshot['etag'])
+                if snapshot.get('last_modified'):
+                    request.add_header('If-Modified-Since',
+                                       snapshot['last_modified'])
+            response = urllib2.urlopen(request)
+            try:
+                body, body_temp = open_snapshot_body()
+                try:
+                    matches = parse_addresses(
+                        stream_addresses(TeeReader(response, body)),
+                        "InterMapper")
+                except:
+                    discard_file(body_temp)
+                    raise
+                finally:
+                    if body:
+                        body.close()
+                headers = response.info()
+                save_snapshot(matches, headers.get('ETag'),
+                              headers.get('Last-Modified'), body_temp)
+            finally:
+                response.close()
             pretty_print (prompt, 1)
             break;
         except urllib2.HTTPError as e:
+            # The list hasn't changed since the snapshot was taken.
+            if e.code == 304 and snapshot:
+                matches = array.array(ADDRESS_TYPE, snapshot['addresses'])
+                save_snapshot(matches, snapshot.get('etag'),
+                              snapshot.get('last_modified'), None)
+                pretty_print (prompt, 1)
+                logger.info("InterMapper list not modified; using snapshot ["
+                            + snapshot_file + "].")
+                break;
             logger.warning("Issue authorizing to [" + im_address + "].")
             logger.warning("HTTP Error " + str(e.code))
+            # Asking for credentials can't wait until both lists are loaded.
+            if interrupt_console():
+                pretty_print (prompt)
             pretty_print (prompt, 2)
             message = "Not authorized to access the addres: [" + im_address + "]"
             pretty_print (message)
@@ -684,9 +3215,86 @@ def get_intermapper_web ():
             print e
             sys.exit(10)
 
-    matches = IP_PATTERN.findall(page)
     logger.info("Got InterMapper list from [" + im_address + "].")
-    return matches
+    return AddressRanges.from_addresses(matches)
+
+'''
+################################################################################
+INTERMAPPER SNAPSHOT
+
+    The last InterMapper page downloaded is kept in snapshot_file, and its
+    ETag, Last-Modified date, download time and parsed addresses are kept next
+    to it in snapshot_file.json.  The next request for the page asks the server
+    to only send it if it has changed (If-None-Match/If-Modified-Since); if it
+    hasn't, the saved addresses are used again without parsing anything.  If
+    the snapshot is less than max_age seconds old, the server isn't contacted at
+    all.  Both files are replaced as described in SAVED FILES, and a snapshot
+    that trusted_file() turns down is treated as missing.
+
+    These requests go through urllib2.urlopen(), so they use the authenticated
+    opener installed by im_authenticate() just like a normal download.
+################################################################################
+'''
+def load_snapshot ():
+    if no_snapshot:
+        return None
+    if (not os.path.exists(snapshot_file + ".json")
+            or not trusted_file(snapshot_file + ".json")):
+        return None
+    try:
+        with open(snapshot_file + ".json") as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if snapshot.get('address') != im_address:
+        logger.debug("InterMapper snapshot is for a different address.")
+        return None
+    return snapshot
+
+# 'body_temp' is the temporary file the page was just saved to, if it was
+# downloaded this time.
+def save_snapshot (addresses, etag, last_modified, body_temp):
+    if no_snapshot:
+        return
+    snapshot = {'address': im_address,
+                'etag': etag,
+                'last_modified': last_modified,
+                'fetched': time.time(),
+                'addresses': addresses.tolist()}
+    try:
+        if body_temp:
+            os.rename(body_temp, snapshot_file)
+        with replace_file(snapshot_file + ".json") as f:
+            json.dump(snapshot, f)
+    except (IOError, OSError) as e:
+        discard_file(body_temp)
+        logger.warning("Could not save InterMapper snapshot [" + snapshot_file
+                       + "]: " + str(e.strerror))
+
+# Returns the file to save the page to as it downloads, and its name (see SAVED
+# FILES).
+def open_snapshot_body ():
+    if no_snapshot:
+        return (None, None)
+    try:
+        return open_temp_file(snapshot_file, 'wb')
+    except (IOError, OSError) as e:
+        logger.warning("Could not save InterMapper snapshot [" + snapshot_file
+                       + "]: " + str(e.strerror))
+        return (None, None)
+
+# Passes reads through from 'stream', writing a copy of everything read into
+# 'copy' (if there is one) along the way.
+class TeeReader (object):
+    def __init__ (self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def read (self, size=-1):
+        chunk = self.stream.read(size)
+        if chunk and self.copy:
+            self.copy.write(chunk)
+        return chunk
 
 '''
 ################################################################################
@@ -726,115 +3334,334 @@ def im_authenticate ():
 ################################################################################
 FIND DISPARITY
 
-    Takes in two dictionaries, which are assumed to be formatted as:
-        {IP_Address, hostname}
-    and finds out which items exist in the first list, but not the second.
+    Takes in two AddressRanges and sweeps across both of their range
+    boundaries once, in order (like the merge step of a merge sort), so whole
+    ranges are compared at a time rather than single addresses.  Returns three
+    AddressRanges:
+        - the addresses which exist in the first, but not the second
+        - the addresses which exist in the second, but not the first
+        - the addresses which exist in both
 ################################################################################
 '''
-def differences (positive, negative):
-    different = []
-    for i in range (0, len(positive)):
-        update_progress(i/float(len(positive)))
-        if not (compare (positive[i][0], negative)):
-            different.append(positive[i])
-    update_progress()
-    return different
-
-def compare (value, list):
-    for other in list:
-        if value == other[0]:
-            return True
-    return False
+def differences (first, second):
+    only_first = AddressRanges()
+    only_second = AddressRanges()
+    both = AddressRanges()
+    total = 2 * (len(first.starts) + len(second.starts))
+
+    progress = start_progress(total, "disparity")
+    inside = [False, False]
+    previous = None
+    events = heapq.merge(range_boundaries(first, 0),
+                         range_boundaries(second, 1))
+    for i, (position, side, entering) in enumerate(events):
+        progress.update(i)
+        # Everything between the previous boundary and this one is on the
+        # same side(s).
+        if previous is not None and position > previous:
+            if inside[0] and inside[1]:
+                both.append(previous, position - 1)
+            elif inside[0]:
+                only_first.append(previous, position - 1)
+            elif inside[1]:
+                only_second.append(previous, position - 1)
+        inside[side] = entering
+        previous = position
+    progress.finish()
+    return (only_first, only_second, both)
+
+def range_boundaries (ranges, side):
+    for start, end in ranges.intervals():
+        yield (start, side, True)
+        yield (end + 1, side, False)
 
 '''
 ################################################################################
-PREPARE OUTPUT
-
-    Outputs the given lists in order, with their IP addresses and hostnames
-    spaced out for easy reading.  Any IP addresses with empty hostnames will
-    display "No DNS Entry" (optionally in yellow).
+WRITE REPORT
+
+    Writes out the given sections in order.  Each section is a (title, side,
+    addresses) tuple, where 'side' says which list the disparity belongs to
+    ('radmind' or 'intermapper').  In the normal text format, each section's
+    addresses are listed in order with their IP addresses (turned back into
+    dotted strings here) and hostnames spaced out for easy reading.  Any IP
+    addresses with empty hostnames will display "No DNS Entry" (optionally in
+    yellow).  With --verify-dns, stale PTR records are marked after their
+    hostnames.
+
+    --format json, jsonl or csv write one record per address instead, for
+    other programs to read.  Each record has:
+        ip          the address as a dotted string
+        ip_int      the address as an integer
+        hostname    its hostname, or an empty string
+        dns_status  'ok', 'no_entry', 'error' (the lookup failed) or, with
+                    --verify-dns, 'stale' (see VERIFY HOSTNAMES)
+        sources     which lists have the address
+        side        the side of the disparity it's listed under (in the -f
+                    full listing, the side it's actually on: 'radmind',
+                    'intermapper' or 'both')
+        section     the title of the section it's listed under
+        radmind_files   which Radmind config files list the address
+    'jsonl' is one JSON object per line, 'json' is a single JSON list of them,
+    and 'csv' has a header line and joins 'sources' and 'radmind_files' with
+    semicolons.  In the text format, when more than one Radmind config was
+    read, each Radmind item says which of them it came from.
+
+    Every line is formatted once, as the addresses are read, and written to each
+    of the sinks (anything with a write() method: open files, sys.stdout, a
+    StringIO for the email) before moving on to the next, so the whole report
+    never has to be built up in memory.
 ################################################################################
 '''
-def prep_output (list1, list2):
-    global OUTPUT_TEXT
-    OUTPUT_TEXT = "Radmind items (" + str(len(list1)) + "):"
-    for item in list1:
-        if not item[1] == "False":
-            OUTPUT_TEXT += "\n  {0:<{1}} {2}".format(item[0], (22), item[1])
-        else:
-            OUTPUT_TEXT += "\n  {0:<{1}} {2}".format(item[0], (22), "")
-
-    OUTPUT_TEXT += '\n'
-    OUTPUT_TEXT += "\nInterMapper items (" + str(len(list2)) + "):"
-    for item in list2:
-        if not item[1] == "False":
-            OUTPUT_TEXT += "\n  {0:<{1}} {2}".format(item[0], (22), item[1])
-        else:
-            OUTPUT_TEXT += "\n  {0:<{1}} {2}".format(item[0], (22), "")
+def write_report (sections, results, sinks):
+    if not sinks:
+        return
+    if output_format == 'text':
+        lines = text_lines(sections, results)
+    elif output_format == 'csv':
+        lines = csv_lines(report_records(sections, results))
+    elif output_format == 'json':
+        lines = json_lines(report_records(sections, results))
+    else:
+        lines = jsonl_lines(report_records(sections, results))
+    for line in lines:
+        for sink in sinks:
+            sink.write(line)
+
+def text_lines (sections, results):
+    hostnames = results.hostnames
+    for i, (title, side, addresses) in enumerate(sections):
+        line = title + " (" + str(len(addresses)) + "):\n"
+        if i > 0:
+            line = "\n" + line
+        yield line
+        for address in addresses:
+            hostname = hostnames.get(address, "False")
+            if hostname == "False":
+                hostname = ""
+            elif hostname == "None":
+                hostname = "(lookup failed)"
+            elif address in results.stale:
+                hostname += "  " + stale_note(results.stale[address])
+            # Only worth saying when there's more than one config.
+            if ((side or address_side(results, address)) in ('radmind', 'both')
+                    and len(results.radmind_files) > 1):
+                files = radmind_files(results, address)
+                if files:
+                    hostname += "  (from " + ', '.join(files) + ")"
+            yield "  {0:<{1}} {2}\n".format(int_to_ip(address), (22), hostname)
+
+def report_records (sections, results):
+    for title, side, addresses in sections:
+        for address in addresses:
+            hostname, status = hostname_status(results.hostnames.get(address,
+                                                                     "False"))
+            if status == 'ok' and address in results.stale:
+                status = 'stale'
+            record = collections.OrderedDict()
+            record['ip'] = int_to_ip(address)
+            record['ip_int'] = address
+            record['hostname'] = hostname
+            record['dns_status'] = status
+            record['sources'] = address_sources(results, address)
+            record['side'] = side or address_side(results, address)
+            record['section'] = title
+            record['radmind_files'] = radmind_files(results, address)
+            yield record
+
+# Returns the hostname to show and its dns_status: 'ok', 'no_entry' (the
+# address has no hostname) or 'error' (the lookup failed).  (With
+# --verify-dns, 'ok' becomes 'stale' for a stale PTR record.)
+def hostname_status (hostname):
+    if hostname == "False":
+        return ("", 'no_entry')
+    if hostname == "None":
+        return ("", 'error')
+    return (hostname, 'ok')
+
+def jsonl_lines (records):
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+def json_lines (records):
+    separator = "[\n"
+    for record in records:
+        yield separator + json.dumps(record)
+        separator = ",\n"
+    if separator == "[\n":
+        yield "[]\n"
+    else:
+        yield "\n]\n"
+
+def csv_lines (records):
+    # The csv module only writes to files, so each row is written into a small
+    # buffer and handed on from there.
+    buffer = StringIO.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(REPORT_FIELDS)
+    for record in records:
+        record['sources'] = ';'.join(record['sources'])
+        record['radmind_files'] = ';'.join(record['radmind_files'])
+        writer.writerow([record[field] for field in REPORT_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Nothing but the header was written.
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+def report_header ():
+    if output_format != 'text':
+        return ""
+    date = datetime.datetime.now().strftime('%Y-%m-%d at %X %Z')
+    return "Generated " + date + "\n\n"
 
 '''
 ################################################################################
 OUTPUT TO FILE
 
-    If the user specifies the '-o' option for output, this handles the
-    formatting and writing of that file.
+    If the user specifies the '-o' option for output, this opens that file (with
+    a generous write buffer) and writes the header, so that write_report() can
+    write the rest straight into it.  (With --routes, each team's report is
+    written the same way to a file of its own; see team_output_path().)
 ################################################################################
 '''
-# def file_output (list1, list2):
-def file_output ():
-    prompt = "Outputting to file [" + out_file + "]..."
-    pretty_print (prompt)
+def open_file_output (path=None):
+    path = path or out_file
+    try:
+        report_file = open (path, 'w', FILE_BUFFER)
+        report_file.write(report_header())
+    except IOError as e:
+        prompt = "Outputting to file [" + path + "]..."
+        pretty_print (prompt)
+        logger.error("Error writing to file: " + e.strerror)
+        pretty_print (prompt, 2)
+        sys.exit(21)
+    return report_file
 
+def close_file_output (report_file):
+    prompt = "Outputting to file [" + report_file.name + "]..."
+    pretty_print (prompt)
     try:
-        sys.stdout = open (out_file, 'w')
+        report_file.close()
     except IOError as e:
         logger.error("Error writing to file: " + e.strerror)
         pretty_print (prompt, 2)
         sys.exit(21)
-    date = datetime.datetime.now().strftime('%Y-%m-%d at %X %Z')
-    print "Generated " + date
-    print
-    print OUTPUT_TEXT
-    sys.stdout = sys.__stdout__
     pretty_print (prompt, 1)
-    logger.info("Output to file [" + out_file + "].")
+    logger.info("Output to file [" + report_file.name + "].")
 
 '''
 ################################################################################
 EMAIL RESULTS
 
-    Sends the results (as they would appear in file_output()) to the email
-    address specified in email_address.
+    Sends the results (as they would appear in the output file) to the email
+    address(es) specified in email_address.
+
+    send_email() takes a list of messages (each with its own recipients) and
+    sends them all over a single SMTP connection, switching it to TLS first
+    with --smtp-starttls and logging in with --smtp-user.  It's usually run as
+    a BackgroundTask so the rest of the output doesn't wait on the server.
+
+    If the connection fails or the server gives a temporary (4xx) error, the
+    messages that haven't gone yet are tried again on a new connection, up to
+    email_retries more times, waiting EMAIL_BACKOFF seconds the first time and
+    twice as long each time after.  Anything else (a 5xx reply, a refused
+    recipient, no STARTTLS support) isn't retried.
+    Either way, if the mail can't be sent the program exits with code 30.
 ################################################################################
 '''
-def send_email ():
-    prompt = "Sending email to [" + destination_email + "]..."
-    pretty_print (prompt)
+def email_recipients ():
+    return [address.strip() for address in destination_email.split(',')
+            if address.strip()]
 
-    # Get date
-    short_date = datetime.datetime.now().strftime('%A, %B %d')
-    full_date = datetime.datetime.now().strftime('%Y-%m-%d at %X %Z')
+def email_message (body, recipients, subject=None):
+    if not subject:
+        short_date = datetime.datetime.now().strftime('%A, %B %d')
+        subject = "Radmind/Intermapper Differences " + short_date
 
     # Create message container
-    msg = MIMEText("Generated " + full_date + "\n\n" + OUTPUT_TEXT)
-    msg['Subject'] = "Radmind/Intermapper Differences " + short_date
+    msg = MIMEText(body)
+    msg['Subject'] = subject
     msg['From'] = source_email
-    msg['To'] = destination_email
+    msg['To'] = ", ".join(recipients)
+    return (recipients, msg)
 
+def wait_for_email (mail, messages):
+    prompt = "Sending email to [" + ", ".join(
+        msg['To'] for recipients, msg in messages) + "]..."
+    pretty_print (prompt)
     try:
-        s = smtplib.SMTP(smtp_server)
-        s.sendmail(msg['From'], [msg['To']], msg.as_string())
-        s.quit
-        pretty_print (prompt, 1)
-    except socket.error as e:
+        mail.result()
+    except SystemExit:
         pretty_print (prompt, 2)
-        logger.error("Could not send email.")
-        logger.error(str(e))
+        raise
+    pretty_print (prompt, 1)
+
+def send_email (messages):
+    pending = list(messages)
+    attempt = 0
+    while pending:
+        connection = None
+        try:
+            connection = smtp_connect()
+            while pending:
+                recipients, msg = pending[0]
+                connection.sendmail(source_email, recipients, msg.as_string())
+                pending.pop(0)
+                count('emails_sent')
+                logger.info(("Sent output via email.\n"
+                             + "{0:24}\tSMTP: " + smtp_server + "\n"
+                             + "{0:24}\tFrom: " + source_email + "\n"
+                             + "{0:24}\tTo:   " + msg['To']).format(''))
+        except (socket.error, smtplib.SMTPException) as e:
+            logger.warning("Could not send email: " + str(e))
+            # Only a dropped connection or a 4xx reply is worth trying again.
+            if isinstance(e, smtplib.SMTPResponseException):
+                temporary = e.smtp_code < 500
+            elif isinstance(e, smtplib.SMTPException):
+                temporary = isinstance(e, smtplib.SMTPServerDisconnected)
+            else:
+                temporary = True
+            if not temporary or attempt >= email_retries:
+                logger.error("Could not send email.")
+                sys.exit(30)
+            wait = EMAIL_BACKOFF * 2 ** attempt
+            attempt += 1
+            logger.warning("Trying again in " + str(wait) + " seconds ("
+                           + str(len(pending)) + " messages left).")
+            count('email_retries')
+            time.sleep(wait)
+        finally:
+            smtp_close(connection)
+
+def smtp_connect ():
+    connection = smtplib.SMTP(smtp_server)
+    if smtp_starttls:
+        connection.ehlo()
+        connection.starttls()
+        connection.ehlo()
+    if smtp_user:
+        connection.login(smtp_user, smtp_password())
+    return connection
+
+def smtp_close (connection):
+    if not connection:
+        return
+    try:
+        connection.quit()
+    except (socket.error, smtplib.SMTPException):
+        connection.close()
+
+def smtp_password ():
+    if not smtp_password_file:
+        return ""
+    try:
+        with open(smtp_password_file) as f:
+            return f.readline().rstrip('\r\n')
+    except IOError as e:
+        logger.error("Could not read SMTP password from ["
+                     + smtp_password_file + "]: " + e.strerror)
         sys.exit(30)
-    logger.info(("Sent output via email.\n"
-                 + "{0:24}\tSMTP: " + smtp_server + "\n"
-                 + "{0:24}\tFrom: " + source_email + "\n"
-                 + "{0:24}\tTo:   " + destination_email).format(''))
 
 '''
 ################################################################################
@@ -874,9 +3701,11 @@ PROPER SPACING FOR FORMATTING
 ################################################################################
 '''
 def pretty_print (s, i = 0):
-    # If we're being quiet, just don't do anything.
-    if quiet:
+    # If we're being quiet, just don't do anything.  The same goes while both
+    # lists are being loaded at once, since their messages would be jumbled.
+    if quiet or (HELD_CONSOLE and HELD_CONSOLE.holds()):
         return
+    console = console_stream()
     # Create the wrapped text.
     # By default, it will wrap at 70 characters.
     dedented_text = textwrap.dedent(s).strip()
@@ -890,49 +3719,204 @@ def pretty_print (s, i = 0):
         lines.append(line)
     # Success
     if i == 1:
-        print "{0:>{1}}".format("[done]", 79 - len(lines[-1]))
+        print >>console, "{0:>{1}}".format("[done]", 79 - len(lines[-1]))
     # Failure
     elif i == 2:
-        print "{0:>{1}}".format("[failed]", 79 - len(lines[-1]))
+        print >>console, "{0:>{1}}".format("[failed]", 79 - len(lines[-1]))
     # Print the message
     else:
-        print text,
+        print >>console, text,
 
 '''
 ################################################################################
-PROGRESS BAR
-
-    A progress bar can be useful for a user.  This method was copied (with some
-    slight alterations) from Brian Khuu's post here:
-        http://stackoverflow.com/questions/3160699/python-progress-bar
+PROGRESS BARS
+
+    A progress bar can be useful for a user.  (The look of the bar was copied,
+    with some slight alterations, from Brian Khuu's post here:
+        http://stackoverflow.com/questions/3160699/python-progress-bar)
+
+    start_progress() gives back something with update(done) and finish()
+    methods.  Writing to the terminal is slow (very slow over SSH), so
+    update() is cheap to call for every item: it only considers redrawing once
+    every half a percent, and only actually redraws if PROGRESS_INTERVAL
+    seconds have passed since the last time.  Each redraw shows how many items
+    a second are going by and about how long is left.
+
+    With -q, or when the console isn't a terminal (a cron job, or output piped
+    into a file), start_progress() hands back a NullProgress, which does
+    nothing at all.
+
+    More than one bar can be running at once (from different threads); they
+    share the one line, each drawn smaller, and PROGRESS_LOCK keeps them from
+    drawing over each other.
 ################################################################################
 '''
-def update_progress(progress=1):
-    # If we're being quiet, just don't do anything.
-    if quiet:
+def start_progress (total, name):
+    if quiet or not console_stream().isatty():
+        return NullProgress()
+    return Progress(total, name)
+
+class NullProgress (object):
+    def update (self, done):
+        pass
+
+    def finish (self, failed=False):
+        pass
+
+class Progress (object):
+    def __init__ (self, total, name):
+        self.total = max(total, 1)
+        self.name = name
+        self.done = 0
+        self.started = time.time()
+        self.drawn = 0
+        self.step = max(1, self.total // 200)
+        self.checkpoint = 0
+        with PROGRESS_LOCK:
+            ACTIVE_PROGRESS.append(self)
+            draw_progress()
+
+    def update (self, done):
+        if done < self.checkpoint:
+            return
+        self.checkpoint = done + self.step
+        now = time.time()
+        if now - self.drawn < PROGRESS_INTERVAL:
+            return
+        self.drawn = now
+        self.done = done
+        with PROGRESS_LOCK:
+            draw_progress()
+
+    def finish (self, failed=False):
+        if not failed:
+            self.done = self.total
+        with PROGRESS_LOCK:
+            ACTIVE_PROGRESS.remove(self)
+            text = self.bar(50) + self.speed(time.time() - self.started)
+            if failed:
+                status = "[failed]"
+            else:
+                status = "[done]"
+            console = console_stream()
+            console.write("\r    " + text + "{0:>{1}}\n".format(
+                status, max(len(status) + 1, 75 - len(text))))
+            draw_progress()
+
+    def bar (self, length):
+        progress = min(1.0, self.done / float(self.total))
+        block = int(round(length * progress))
+        return "[{0}] {1:>5}%".format("#" * block + "-" * (length - block),
+                                     math.floor(progress * 1000) / 10)
+
+    def speed (self, elapsed):
+        if elapsed <= 0 or not self.done:
+            return ""
+        rate = self.done / elapsed
+        text = "  {0:,.0f}/s".format(rate)
+        if self.done < self.total:
+            left = int((self.total - self.done) / rate)
+            text += "  ETA {0}:{1:02d}".format(left // 60, left % 60)
+        return text
+
+# Draws every active bar on the current line.  Must be called with
+# PROGRESS_LOCK held.
+def draw_progress ():
+    if not ACTIVE_PROGRESS:
         return
-    # Modify this to change the length of the progress bar:
-    barLength = 50
-    status = ""
-    if isinstance(progress, int):
-        progress = float(progress)
-    if not isinstance(progress, float):
-        progress = 0
-        status = "Error: progress var must be float.\r\n"
-    if progress < 0:
-        progress = 0
-        status = "[failed]\r\n"
-    if progress >= 1:
-        progress = 1
-        status = "  [done]\r\n"
-    amount = math.ceil(progress*1000)/10
-    block = int(round(barLength*progress))
-    text = "\r    [{0}] {1:>5}%{2:>{3}}".format("#"*block + "-"*(barLength-block),
-                                                amount,
-                                                status,
-                                                24 - len(str(amount)))
-    sys.stdout.write(text)
-    sys.stdout.flush()
+    if len(ACTIVE_PROGRESS) == 1:
+        bar = ACTIVE_PROGRESS[0]
+        text = bar.bar(50) + bar.speed(time.time() - bar.started)
+    else:
+        text = "  ".join(bar.name + " " + bar.bar(10)
+                         for bar in ACTIVE_PROGRESS)
+    console = console_stream()
+    console.write("\r    " + text.ljust(75))
+    console.flush()
+
+'''
+################################################################################
+CONSOLE STREAM
+
+    Progress messages normally go to stdout along with the report.  When the
+    report is in one of the machine-readable formats, they go to stderr instead
+    so that the report on stdout can be piped straight into another program.
+################################################################################
+'''
+def console_stream ():
+    if output_format == 'text':
+        return sys.stdout
+    return sys.stderr
+
+'''
+################################################################################
+HELD CONSOLE
+
+    While both lists are loading at once (see LOAD SOURCES), anything they
+    printed would land in the middle of the combined "Getting Radmind and
+    InterMapper lists..." line.  hold_console() keeps pretty_print() quiet and
+    holds back the records logged to the console (the log file still gets them
+    straight away); release_console() stops holding, and the HeldConsole it
+    hands back writes the held records out with flush(), once the combined
+    "[done]" or "[failed]" is on the screen.
+
+    The one thing that can't wait is asking the user for InterMapper
+    credentials.  interrupt_console() ends the combined line and lets this
+    thread's messages through again from there on (the Radmind thread stays
+    quiet), and returns True if it was the one to end the line.
+################################################################################
+'''
+def hold_console ():
+    global HELD_CONSOLE
+    HELD_CONSOLE = HeldConsole(logging.getLogger().handlers)
+
+def release_console ():
+    global HELD_CONSOLE
+    held, HELD_CONSOLE = HELD_CONSOLE, None
+    held.release()
+    return held
+
+def interrupt_console ():
+    if not HELD_CONSOLE or HELD_CONSOLE.interrupted:
+        return False
+    HELD_CONSOLE.interrupted = True
+    if not quiet:
+        print >>console_stream()
+    return True
+
+class HeldConsole (object):
+    def __init__ (self, handlers):
+        self.thread = threading.current_thread()
+        self.interrupted = False
+        self.filters = []
+        for handler in handlers:
+            hold = HeldRecords()
+            handler.addFilter(hold)
+            self.filters.append((handler, hold))
+
+    # Whether pretty_print() should keep quiet on the current thread.
+    def holds (self):
+        return (not self.interrupted
+                or threading.current_thread() is not self.thread)
+
+    def release (self):
+        for handler, hold in self.filters:
+            handler.removeFilter(hold)
+
+    def flush (self):
+        for handler, hold in self.filters:
+            for record in hold.records:
+                handler.handle(record)
+            del hold.records[:]
+
+class HeldRecords (logging.Filter):
+    def __init__ (self):
+        logging.Filter.__init__(self)
+        self.records = []
+
+    def filter (self, record):
+        self.records.append(record)
+        return False
 
 '''
 ################################################################################